@@ -275,12 +275,17 @@ class PdfFileWriter(object):
         self._encrypt = self._addObject(encrypt)
         self._encrypt_key = key
 
-    def write(self, stream):
+    def write(self, stream, progress=None):
         """
         Writes the collection of pages added to this object out as a PDF file.
 
         :param stream: An object to write the file to.  The object must support
             the write method and the tell method, similar to a file object.
+        :param progress: Optional callable, called as ``progress(done, total)``
+            after each object is written.  While the objects to write are
+            still being collected from the source documents, it is called
+            with the number collected so far and a ``total`` of ``None``.
+            An exception raised by it aborts the write.
         """
         if hasattr(stream, 'mode') and 'b' not in stream.mode:
             warnings.warn("File <%s> to write to is not in binary mode. It may not be written to correctly." % stream.name)
@@ -311,9 +316,11 @@ class PdfFileWriter(object):
                 externalReferenceMap[data.pdf][data.generation][data.idnum] = IndirectObject(objIndex + 1, 0, self)
 
         self.stack = []
+        self._sweepProgress = progress
         if debug: print(("ERM:", externalReferenceMap, "root:", self._root))
         self._sweepIndirectReferences(externalReferenceMap, self._root)
         del self.stack
+        del self._sweepProgress
 
         # Begin writing:
         object_positions = []
@@ -333,6 +340,8 @@ class PdfFileWriter(object):
                 key = md5_hash[:min(16, len(self._encrypt_key) + 5)]
             obj.writeToStream(stream, key)
             stream.write(b_("\nendobj\n"))
+            if progress is not None:
+                progress(idnum, len(self._objects))
 
         # xref table
         xref_location = stream.tell()
@@ -409,6 +418,8 @@ class PdfFileWriter(object):
                     newobj = data.pdf.getObject(data)
                     self._objects.append(None) # placeholder
                     idnum = len(self._objects)
+                    if self._sweepProgress is not None:
+                        self._sweepProgress(idnum, None)
                     newobj_ido = IndirectObject(idnum, 0, self)
                     if data.pdf not in externMap:
                         externMap[data.pdf] = {}
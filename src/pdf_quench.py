@@ -30,10 +30,29 @@ gi.require_version('Poppler', '0.18')
 gi.require_version('Gdk', '3.0')
 gi.require_version('GdkPixbuf', '2.0')
 import cairo
-from gi.repository import Gtk, GooCanvas, Pango, Poppler, Gdk, GdkPixbuf
-from collections import namedtuple
+from gi.repository import Gtk, GooCanvas, Pango, Poppler, Gdk, GdkPixbuf, GLib
+from gi.repository import GObject
+from collections import namedtuple, OrderedDict
+from array import array
+import bisect
+import hashlib
+import inspect
+import heapq
+import itertools
+import math
+import mmap
+import multiprocessing
 import os
+import struct
 import sys
+import threading
+import traceback
+import zlib
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 # Temporary workaround to avoid the "maximum recursion depth exceeded" error.
 sys.setrecursionlimit(65536)
@@ -45,9 +64,85 @@ from PyPDF2 import PdfFileWriter, PdfFileReader
 VERSION = '1.0.2'
 LAST_OPEN_FOLDER   = None
 NEXT_INDEX = 0
-CROP_SETTING_NAMES = set(['x', 'y', 'w', 'h'])
 ZOOM_LEVELS = (0.3, 0.5, 0.8, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0)
 DEFAULT_ZOOM_LEVEL = 3
+# Zoom factor of one Ctrl+scroll step, and how long the zoom has to stay
+# unchanged before the page is rendered again at the new scale.
+ZOOM_STEP = 1.1
+ZOOM_REFINE_DELAY_MS = 150
+# Memory budget of the rendered page cache, in MB.
+RENDER_CACHE_MB = int(os.environ.get('PDF_QUENCH_CACHE_MB', 256))
+# Number of pages before and after the current one rendered ahead of time.
+PREFETCH_PAGES = 2
+# Scale of the quick preview shown while a page is rendered at full zoom.
+PREVIEW_SCALE = ZOOM_LEVELS[0]
+PRIORITY_PAGE = 0
+PRIORITY_THUMBNAIL = 5
+PRIORITY_PREFETCH = 10
+# Disk cache writes wait behind every render.
+PRIORITY_STORE = 20
+# Size limit of the on-disk cache of rendered pages and thumbnails, in MB.
+DISK_CACHE_MB = int(os.environ.get('PDF_QUENCH_DISK_CACHE_MB', 1024))
+# Number of pages measured at a time by the background geometry scan.
+GEOMETRY_SCAN_CHUNK = 200
+# Number of leading pages looked at to detect grayscale documents.
+GRAY_DETECT_PAGES = 3
+# Auto-crop renders pages at this scale and counts a pixel as ink when its
+# darkest channel is more than AUTOCROP_THRESHOLD below white. Rows and
+# columns with fewer than AUTOCROP_MIN_INK ink pixels are noise (dust, scan
+# speckles). The box found is padded by AUTOCROP_MARGIN points.
+AUTOCROP_SCALE = 0.5
+AUTOCROP_THRESHOLD = 32
+AUTOCROP_MIN_INK = 2
+AUTOCROP_MARGIN = 6
+# The text layout gives no crop suggestion for a page whose images cover more
+# than this fraction of it, like a scan with an OCR text layer: the image
+# would make the whole page content.
+LAYOUT_IMAGE_COVERAGE = 0.5
+# Processes working on all the pages of a document (auto-cropping them or
+# superimposing them), and pages handed to a process at a time.
+PAGE_TASK_PROCESSES = int(os.environ.get('PDF_QUENCH_PROCESSES',
+                                         os.cpu_count() or 1))
+PAGE_TASK_CHUNK = 16
+# The document of a page task process.
+PAGE_TASK_DOCUMENT = None
+# When all the pages are auto-cropped, a page whose box reaches more than
+# CROP_OUTLIER_POINTS beyond the typical box of its odd or even group keeps
+# a box of its own rather than widening the crop of the whole group.
+CROP_OUTLIER_POINTS = 36
+# Grouping pages by layout looks for at most CROP_CLUSTERS groups, in which
+# no page is further than CROP_OUTLIER_POINTS from the typical page, with
+# k-means runs of at most CLUSTER_ITERATIONS iterations.
+CROP_CLUSTERS = 8
+CLUSTER_ITERATIONS = 25
+# Scale at which pages are superimposed in the ghost image.
+GHOST_SCALE = 0.25
+# Largest side of the page thumbnails, in pixels, and the memory budget of
+# the thumbnail cache, in MB.
+THUMBNAIL_SIZE = 96
+THUMBNAIL_CACHE_MB = 32
+# Pages whose bitmap would exceed this size are rendered in tiles, and only
+# the tiles around the visible part of the canvas are rendered.
+TILED_RENDER_BYTES = 32 * 1024 * 1024
+TILE_SIZE = 512
+TILE_MARGIN = 256
+
+# Poppler documents must not be used from several threads at once, so every
+# call into a document (on the main loop or in a worker) holds this lock.
+POPPLER_LOCK = threading.RLock()
+# Space between the pages of the continuous view, and how far above and below
+# the viewport pages are kept on the canvas, in canvas units.
+CONTINUOUS_GAP = 12
+CONTINUOUS_MARGIN = 1024
+# How often the progress bar pulses while a document is being opened, in ms.
+LOAD_PULSE_MS = 100
+# Stack size of the export thread. PyPDF2 walks the object tree recursively,
+# which needs far more than the default thread stack (see the recursion limit
+# below).
+EXPORT_STACK_SIZE = 256 * 1024 * 1024
+# While the objects of the export are collected from the source, their total
+# is unknown and the progress bar pulses once per that many objects.
+EXPORT_PULSE_OBJECTS = 500
 
 
 def next_index():
@@ -57,72 +152,574 @@ def next_index():
   return index
 
 
-class CropSetting(object):
-  def __init__(self, parent=None):
-    self.__parent = parent
-    self.__params = {}
+# Cropping boxes of all the pages of a document, in PDF points, in flat
+# arrays: one row per page followed by the default, odd and even rows and
+# the rows of any page groups. A row holds x, y, w, h (x is NaN while
+# undefined) and the row it inherits from, so resolving the effective box of
+# a page takes at most three lookups.
+#
+# 1-st page share its cropping settings with all pages until 2-nd page
+# cropping is configured. Then, 1-st and 2-nd pages do share its cropping
+# settings with odd and even pages respectively. Cropping for other pages is
+# configured independently. To that end a page may be an alias of another
+# row, which it reads and writes its settings to instead of its own: the
+# 1-st and 2-nd pages are aliases of the odd and even rows, and the pages of
+# a group (see set_clusters) of the group row.
+class CropTable(object):
+  def __init__(self, n_pages, previous=None):
+    self.__n_pages = n_pages
+    self.DEFAULT = n_pages
+    self.ODD = n_pages + 1
+    self.EVEN = n_pages + 2
+    n_rows = n_pages + 3
+    self.__rects = array('d', [float('nan')]) * (4 * n_rows)
+    self.__parents = array('i', [self.ODD, self.EVEN]) * ((n_pages + 1) // 2)
+    del self.__parents[n_pages:]
+    self.__parents.extend([-1, self.DEFAULT, self.DEFAULT])
+    self.__aliases = array('i', [-1]) * n_pages
+    self.__reset_aliases()
+    if previous is not None:
+      # The default, odd and even settings carry over to the next document.
+      for row, previous_row in ((self.DEFAULT, previous.DEFAULT),
+                                (self.ODD, previous.ODD),
+                                (self.EVEN, previous.EVEN)):
+        rect = previous.__rect(previous_row)
+        if rect:
+          self.__set_rect(row, rect)
+
+
+  def __reset_aliases(self):
+    # Back to the 1-st and 2-nd pages only, without page groups.
+    for pagenum in range(self.__n_pages):
+      self.__aliases[pagenum] = -1
+    for pagenum, row in enumerate((self.ODD, self.EVEN)[:self.__n_pages]):
+      self.__aliases[pagenum] = row
+    n_rows = self.__n_pages + 3
+    del self.__rects[4 * n_rows:]
+    del self.__parents[n_rows:]
+
+
+  def __len__(self):
+    return self.__n_pages
+
+
+  def row(self, pagenum):
+    # The row a page writes its settings to.
+    row = self.__aliases[pagenum]
+    return row if row >= 0 else pagenum
+
+
+  def __defined(self, row):
+    return not math.isnan(self.__rects[4 * row])
+
+
+  def __rect(self, row):
+    if not self.__defined(row):
+      return None
+    return tuple(self.__rects[4 * row:4 * row + 4])
+
+
+  def __set_rect(self, row, rect):
+    self.__rects[4 * row:4 * row + 4] = array('d', rect)
+
+
+  def source(self, pagenum):
+    # The row the effective settings of a page come from, or -1.
+    row = self.row(pagenum)
+    while row >= 0 and not self.__defined(row):
+      row = self.__parents[row]
+    return row
+
+
+  def get(self, pagenum):
+    row = self.source(pagenum)
+    return self.__rect(row) if row >= 0 else None
+
+
+  def set(self, pagenum, x, y, w, h):
+    row = self.row(pagenum)
+    self.__set_rect(row, (x, y, w, h))
+    # Also define undefined settings of parents
+    parent = self.__parents[row]
+    while parent >= 0 and not self.__defined(parent):
+      self.__set_rect(parent, (x, y, w, h))
+      parent = self.__parents[parent]
+
+
+  def set_groups(self, odd, even, overrides):
+    # Replaces the settings of all the pages: odd and even pages get the
+    # given boxes (None keeps the current one), the pages in overrides their
+    # own box, and all the other pages follow their group again. A 1-st or
+    # 2-nd page in overrides stops being an alias of its group, whose 1-st
+    # page left in it takes over.
+    if odd:
+      self.__set_rect(self.ODD, odd)
+    if even:
+      self.__set_rect(self.EVEN, even)
+    if not self.__defined(self.DEFAULT) and (odd or even):
+      self.__set_rect(self.DEFAULT, odd or even)
+    self.__reset_aliases()
+    for pagenum in range(self.__n_pages):
+      self.__set_rect(pagenum, overrides.get(pagenum, (float('nan'),) * 4))
+    for first, row in ((0, self.ODD), (1, self.EVEN)):
+      pagenums = range(first, self.__n_pages, 2)
+      if first in overrides:
+        self.__aliases[first] = -1
+        alias = next((p for p in pagenums if p not in overrides), None)
+        if alias is not None:
+          self.__aliases[alias] = row
 
 
-  def __getitem__(self, name):
-    if name in CROP_SETTING_NAMES:
-      if name not in self.__params:
-        if self.__parent is None:
-          raise KeyError()
-        return self.__parent[name]
-      else:
-        return self.__params[name]
-    else:
-      raise KeyError()
+  def set_clusters(self, clusters):
+    # Replaces the settings of all the pages by page groups: clusters lists
+    # the box and the pages of every group. The pages of a group share its
+    # settings, editing one page edits the group; pages in no group follow
+    # the odd and even settings again.
+    self.__reset_aliases()
+    for pagenum in range(self.__n_pages):
+      self.__set_rect(pagenum, (float('nan'),) * 4)
+    for rect, pagenums in clusters:
+      row = len(self.__parents)
+      self.__rects.extend(array('d', rect))
+      self.__parents.append(self.DEFAULT)
+      for pagenum in pagenums:
+        self.__aliases[pagenum] = row
+    if not self.__defined(self.DEFAULT) and clusters:
+      self.__set_rect(self.DEFAULT, clusters[0][0])
+
+
+  def groups(self):
+    # Number of page groups.
+    return len(self.__parents) - self.__n_pages - 3
+
+
+  def empty(self, pagenum):
+    return self.source(pagenum) < 0
+
+
+# A read-only memory mapping of a PDF file. It is read once, from the page
+# cache, by everybody: Poppler gets the document from it and every PyPDF2
+# reader gets a stream() over it, each with its own position so that readers
+# in different threads do not move each other's file pointer. The mapping is
+# unmapped when the last of them lets it go.
+class MappedFile(object):
+  def __init__(self, filename):
+    self.filename = filename
+    with open(filename, 'rb') as fh:
+      self.__map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+  def __len__(self):
+    return len(self.__map)
+
+
+  def stream(self):
+    return MappedStream(self.__map)
+
+
+  def open_document(self):
+    # Poppler versions before 0.82 only open documents by URI. The GBytes of
+    # a GLib mapping of the file shares the page cache like the Python one,
+    # which stays for PyPDF2, where a GBytes built from Python bytes would
+    # copy the whole file twice.
+    if hasattr(Poppler.Document, 'new_from_bytes'):
+      mapping = GLib.MappedFile.new(self.filename, False)
+      return Poppler.Document.new_from_bytes(mapping.get_bytes(), None)
+    return Poppler.Document.new_from_file('file://%s' % self.filename, None)
+
+
+class MappedStream(object):
+  mode = 'rb'
+
+  def __init__(self, mapping):
+    self.__map = mapping
+    self.__pos = 0
+
+
+  def read(self, size=-1):
+    end = len(self.__map) if size < 0 else self.__pos + size
+    data = self.__map[self.__pos:end]
+    self.__pos += len(data)
+    return data
+
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      offset += self.__pos
+    elif whence == os.SEEK_END:
+      offset += len(self.__map)
+    if offset < 0:
+      raise IOError('Invalid seek to %d' % offset)
+    self.__pos = offset
+    return offset
+
+
+  def tell(self):
+    return self.__pos
+
+
+  def close(self):
+    self.__map = None
 
 
-  def __setitem__(self, name, value):
-    if name in CROP_SETTING_NAMES:
-      # Also define undefined value of parent
-      if self.__parent is not None and name not in self.__parent.__params:
-        self.__parent[name] = value
+  def __enter__(self):
+    return self
 
-      self.__params[name] = value
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+# Opens a document in a background thread, so that a large or slow file does
+# not freeze the window. on_loaded gets the document, its page count, the
+# size of the 1-st page and the file mapping (None when the file could not be
+# mapped) on the GTK main loop, or on_failed the error.
+class DocumentLoader(object):
+  def __init__(self, filename, on_loaded, on_failed):
+    self.__filename = filename
+    self.__on_loaded = on_loaded
+    self.__on_failed = on_failed
+    self.cancelled = False
+    thread = threading.Thread(target=self.__run, name='document-loader')
+    thread.daemon = True
+    thread.start()
+
+
+  def __run(self):
+    try:
+      try:
+        mapped = MappedFile(self.__filename)
+      except (EnvironmentError, ValueError):
+        # Empty files and some file systems cannot be mapped.
+        traceback.print_exc()
+        mapped = None
+      with POPPLER_LOCK:
+        if mapped is not None:
+          document = mapped.open_document()
+        else:
+          document = Poppler.Document.new_from_file(
+              'file://%s' % self.__filename, None)
+        n_pages = document.get_n_pages()
+        first_size = document.get_page(0).get_size() if n_pages else None
+    except Exception as e:
+      traceback.print_exc()
+      GLib.idle_add(self.__deliver, self.__on_failed, e)
     else:
-      raise KeyError()
+      GLib.idle_add(self.__deliver, self.__on_loaded,
+                    document, n_pages, first_size, mapped)
+
+
+  def __deliver(self, callback, *args):
+    if not self.cancelled:
+      callback(*args)
+    return False
+
+
+# Size of every page of a document. It is filled in by a GeometryScan after
+# the document is opened; until then pages report the size of the 1-st page.
+class PageGeometry(object):
+  def __init__(self, n_pages, default_size=(0.0, 0.0)):
+    self.__widths = array('d', [default_size[0]]) * n_pages
+    self.__heights = array('d', [default_size[1]]) * n_pages
+    self.scanned = 0
+
+
+  def __len__(self):
+    return len(self.__widths)
+
+
+  def size(self, pagenum):
+    return self.__widths[pagenum], self.__heights[pagenum]
+
+
+  @property
+  def heights(self):
+    return self.__heights
+
+
+  def max_size(self):
+    if not len(self):
+      return 0.0, 0.0
+    return max(self.__widths), max(self.__heights)
 
 
-  def empty(self):
-    # Check if all coordinates are defined (at least by parents)
-    defined = set(self.__params.keys())
+  def update(self, start, sizes):
+    end = start + len(sizes)
+    self.__widths[start:end] = array('d', [w for w, _ in sizes])
+    self.__heights[start:end] = array('d', [h for _, h in sizes])
+    self.scanned = max(self.scanned, end)
 
-    while len(defined) < len(CROP_SETTING_NAMES):
-        parent = self.__parent
-        if parent is None:
-            return True
-        defined.update(parent.__params.keys())
-        # Reference to self is not more needed. So, reuse it as a regular
-        # variable.
-        self = parent
+
+# Measures all the pages of a document in a background thread, a chunk of
+# pages at a time so that page renders get the Poppler lock in between. Each
+# chunk is handed to on_chunk on the GTK main loop.
+class GeometryScan(object):
+  def __init__(self, document, n_pages, on_chunk):
+    self.__document = document
+    self.__n_pages = n_pages
+    self.__on_chunk = on_chunk
+    self.cancelled = False
+    thread = threading.Thread(target=self.__run, name='geometry-scan')
+    thread.daemon = True
+    thread.start()
+
+
+  def __run(self):
+    try:
+      for start in range(0, self.__n_pages, GEOMETRY_SCAN_CHUNK):
+        if self.cancelled:
+          return
+        end = min(start + GEOMETRY_SCAN_CHUNK, self.__n_pages)
+        with POPPLER_LOCK:
+          sizes = [self.__document.get_page(i).get_size()
+                   for i in range(start, end)]
+        GLib.idle_add(self.__deliver, start, sizes)
+    except Exception:
+      traceback.print_exc()
+
+
+  def __deliver(self, start, sizes):
+    if not self.cancelled:
+      self.__on_chunk(start, sizes)
+    return False
+
+
+# A PyPDF2 reader over a document whose xref, page tree and page boxes have
+# been loaded ahead of time, so that an export only has to write. A
+# PdfFileWriter rewrites the references inside the objects of the reader it
+# copies pages from, so a reader serves a single export: whoever holds it
+# owns it, and a fresh one is warmed up for the next export.
+class WarmReader(object):
+  def __init__(self, source):
+    self.__stream = open_source(source)
+    try:
+      self.reader = PdfFileReader(self.__stream, strict=False)
+    except Exception:
+      self.__stream.close()
+      raise
+
+
+  def warm(self, pagenum):
+    page = self.reader.getPage(pagenum)
+    # The accessors resolve the inherited boxes and keep them on the page.
+    page.mediaBox
+    page.cropBox
+    return page
+
+
+  def close(self):
+    self.__stream.close()
+
+
+# Builds and warms a WarmReader in a background thread, and hands it to
+# on_ready on the GTK main loop.
+class ReaderWarmup(object):
+  def __init__(self, source, n_pages, on_ready):
+    self.__source = source
+    self.__n_pages = n_pages
+    self.__on_ready = on_ready
+    self.cancelled = False
+    thread = threading.Thread(target=self.__run, name='reader-warmup')
+    thread.daemon = True
+    thread.start()
+
+
+  def __run(self):
+    try:
+      reader = WarmReader(self.__source)
+    except Exception:
+      traceback.print_exc()
+      return
+    try:
+      for pagenum in range(self.__n_pages):
+        if self.cancelled:
+          break
+        reader.warm(pagenum)
+      else:
+        GLib.idle_add(self.__deliver, reader)
+        return
+    except Exception:
+      traceback.print_exc()
+    reader.close()
+
+
+  def __deliver(self, reader):
+    if self.cancelled:
+      reader.close()
+    else:
+      self.__on_ready(reader)
     return False
 
-  def __get_effective_crop_setting(self):
-    if self.__params:
-      return self
-    elif self.__parent:
-      return self.__parent.__get_effective_crop_setting()
+
+# A stream over a document for PyPDF2, given its MappedFile or, if it could
+# not be mapped, its file name.
+def open_source(source):
+  if isinstance(source, MappedFile):
+    return source.stream()
+  return open(source, 'rb')
+
+
+# Crops a PyPDF2 page to crop, a box in PDF points as Poppler sees the page.
+def crop_page(page, crop):
+  x1, y1, w1, h1 = crop
+  # it's strange but cropBox.height != cropBox.upper_left_y -
+  # cropBox.upper_left_x.  we should use the latter.
+  h0 = float(page.cropBox.getUpperLeft_y() -
+             page.cropBox.getLowerLeft_y())
+  w0 = float(page.cropBox.getUpperRight_x() -
+             page.cropBox.getUpperLeft_x())
+
+  # convert poppler coordinates to pyPdf coordinates
+  rotateAngle = page.get("/Rotate", 0)
+  if rotateAngle < 0:
+    rotateAngle = 360 + rotateAngle
+  if rotateAngle == 0:
+    x1, y1 = x1, h0 - y1 - h1
+  elif rotateAngle == 90:
+    x1, y1, w1, h1 = y1, x1, h1, w1
+  elif rotateAngle == 180:
+    pass
+  elif rotateAngle == 270:
+    x1, y1 = h0 - y1 - h1, w0 - x1 - w1
+  else:
+    raise Exception('Invalid rotate angle: %s' % rotateAngle)
+
+  # poppler API provides only width and height while pyPdf
+  # provides far more size information.  poppler width and height
+  # doesn't always match pyPdf mediaBox.  Instead, we need to use
+  # pyPdf cropBox size to rectify the calculated cropping box.
+  x1, y1 = (x1 + float(page.cropBox.getLowerLeft_x()),
+            y1 + float(page.cropBox.getLowerLeft_y()))
+
+  # now let's crop it.
+  page.cropBox.lowerLeft = (x1, y1)
+  page.cropBox.upperRight = (x1+w1, y1+h1)
+  page.mediaBox.lowerLeft = page.cropBox.lowerLeft
+  page.mediaBox.upperRight = page.cropBox.upperRight
+
+
+class ExportCancelled(Exception):
+  pass
+
+
+# Writes the cropped document in a background thread. pages lists the
+# (pagenum, crop) of the pages to keep, taken on the main loop so that the
+# export does not see later edits. The document is written to a temporary
+# file next to filename, which replaces filename only once it is complete.
+# The export takes over reader, a WarmReader, if it is given one.
+# on_progress(text, fraction) and then on_done(error) are called on the GTK
+# main loop; error is None on success and an ExportCancelled if cancelled.
+class Exporter(object):
+  def __init__(self, source, reader, pages, filename, on_progress, on_done):
+    self.__source = source
+    self.__reader = reader
+    self.__pages = pages
+    self.__filename = filename
+    self.__on_progress = on_progress
+    self.__on_done = on_done
+    self.cancelled = False
+    self.__percent = None
+    stack_size = threading.stack_size(EXPORT_STACK_SIZE)
+    try:
+      thread = threading.Thread(target=self.__run, name='exporter')
+      thread.daemon = True
+      thread.start()
+    finally:
+      threading.stack_size(stack_size)
+
+
+  def __run(self):
+    tmp_path = None
+    try:
+      fd, tmp_path = self.__create_part()
+      with os.fdopen(fd, 'wb') as out_fh:
+        # Without a warm reader, e.g. while it is still being warmed
+        # up, the export builds its own.
+        reader = self.__reader or WarmReader(self.__source)
+        self.__reader = None
+        try:
+          self.__export(reader, out_fh)
+        finally:
+          reader.close()
+      os.replace(tmp_path, self.__filename)
+      error = None
+    except Exception as e:
+      if not isinstance(e, ExportCancelled):
+        traceback.print_exc()
+      if self.__reader is not None:
+        self.__reader.close()
+      if tmp_path is not None:
+        os.unlink(tmp_path)
+      error = e
+    GLib.idle_add(self.__deliver, error)
+
+
+  def __create_part(self):
+    # The file written next to the target is renamed over it once complete.
+    # Unlike with mkstemp, which creates it 0600, the umask sets its mode as
+    # it would for a file written in place.
+    prefix = os.path.join(os.path.dirname(os.path.abspath(self.__filename)),
+                          '.' + os.path.basename(self.__filename))
+    while True:
+      path = '%s.%s.part' % (prefix, os.urandom(6).hex())
+      try:
+        return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), path
+      except FileExistsError:
+        continue
+
+
+  def __export(self, reader, out_fh):
+    out_file = PdfFileWriter()
+    for i, (pagenum, crop) in enumerate(self.__pages):
+      self.__progress('Preparing pages: %d / %d', i, len(self.__pages))
+      page = reader.warm(pagenum)
+      if crop:
+        crop_page(page, crop)
+      out_file.addPage(page)
+
+    # A PyPDF2 from the system may not report progress.
+    if 'progress' in inspect.signature(out_file.write).parameters:
+      out_file.write(out_fh, self.__write_progress)
+    else:
+      out_file.write(out_fh)
+
+
+  def __write_progress(self, done, total):
+    # The objects are first collected from the source, with no total known.
+    if total is None:
+      self.__progress('Collecting objects: %d', done, None)
     else:
-      return self
+      self.__progress('Writing objects: %d / %d', done, total)
 
-  effective_crop_setting = property(__get_effective_crop_setting)
 
+  def __progress(self, text, done, total):
+    if self.cancelled:
+      raise ExportCancelled()
+    # Documents have many thousands of objects, the main loop only hears of
+    # every percent, or every EXPORT_PULSE_OBJECTS while the total is unknown.
+    if total is None:
+      percent = (text, done // EXPORT_PULSE_OBJECTS)
+      message, fraction = text % done, None
+    else:
+      fraction = float(done) / total if total else 1.0
+      percent = (text, int(fraction * 100))
+      message = text % (done, total)
+    if percent != self.__percent:
+      self.__percent = percent
+      GLib.idle_add(self.__on_progress, message, fraction)
 
-  def __get_parent_crop_setting(self):
-    return self.__parent
 
-  parent_crop_setting = property(__get_parent_crop_setting)
+  def __deliver(self, error):
+    self.__on_done(error)
+    return False
 
 
 class PageInfo(object):
-  def __init__(self, pagenum, crop_setting, size):
+  def __init__(self, pagenum, crop_table, geometry):
     self.__pagenum = pagenum
-    self.__crop_setting = crop_setting
+    self.__crop_table = crop_table
     self.__deleted = False
-    self.__poppler_size = size
+    self.__geometry = geometry
 
 
   @property
@@ -130,8 +727,12 @@ class PageInfo(object):
     return self.__pagenum
 
   @property
-  def crop_setting(self):
-    return self.__crop_setting
+  def crop(self):
+    # The effective cropping box in PDF points, or None.
+    return self.__crop_table.get(self.__pagenum)
+
+  def set_crop(self, x, y, w, h):
+    self.__crop_table.set(self.__pagenum, x, y, w, h)
 
   @property
   def deleted(self):
@@ -139,408 +740,1033 @@ class PageInfo(object):
 
   @property
   def size(self):
-    return self.__poppler_size
+    return self.__geometry.size(self.__pagenum)
 
 
-class Resizer(GooCanvas.CanvasEllipse):
-  def __init__(self, parent, rect, x, y):
-    self._rect = rect
-    GooCanvas.CanvasEllipse.__init__(self,
-                                     parent=parent,
-                                     center_x=x,
-                                     center_y=y,
-                                     radius_x=5,
-                                     radius_y=5,
-                                     stroke_color="red",
-                                     fill_color="blue",
-                                     line_width=1.0)
-    self.connect("motion_notify_event", self.__on_motion_notify)
-    self.connect("button_press_event", self.__on_button_press)
-    self.connect("button_release_event", self.__on_button_release)
-    self.connect("enter_notify_event", self.__on_mouse_enter)
-    self.connect("leave_notify_event", self.__on_mouse_leave)
-    self.__dragging = False
-    self._cursor = None
-    self._dx_listeners = []
-    self._dx2_listeners = []
-    self._dy_listeners = []
-    self._dy2_listeners = []
-    self._dxdy_listeners = []
-    self._dx2dy_listeners = []
-    self._dxdy2_listeners = []
-
-
-  def set_listeners(self,
-                    dx_listeners=[],
-                    dx2_listeners=[],
-                    dy_listeners=[],
-                    dy2_listeners=[],
-                    dx2dy_listeners=[],
-                    dxdy2_listeners=[]):
-    self._dx_listeners.extend(dx_listeners)
-    self._dx2_listeners.extend(dx2_listeners)
-    self._dy_listeners.extend(dy_listeners)
-    self._dy2_listeners.extend(dy2_listeners)
-    self._dx2dy_listeners.extend(dx2dy_listeners)
-    self._dxdy2_listeners.extend(dxdy2_listeners)
+def page_pixel_size(page, scale):
+  page_width, page_height = page.get_size()
+  w, h = int(int(page_width) * scale), int(int(page_height) * scale)
+  return w, h, min(w/page_width, h/page_height)
 
 
-  def __on_motion_notify(self, item, target, event):
-    if self.__dragging and (event.state & Gdk.ModifierType.BUTTON1_MASK):
-      # don't allow it move out of page
-      bound = item.get_canvas().page_region
-      if (event.x < bound.x or
-          event.y < bound.y or
-          event.x > bound.x + bound.width or
-          event.y > bound.y + bound.height):
-        return True
+# Lazy list model of the pages of a document, with the page label and its
+# PageInfo as columns. Rows are produced on demand from the row index, and a
+# PageInfo is only created the first time its page is asked for, so setting
+# up the model takes constant time whatever the length of the document.
+class PagesModel(GObject.Object, Gtk.TreeModel):
+  def __init__(self, n_pages=0, make_page_info=None):
+    GObject.Object.__init__(self)
+    self.__n_pages = n_pages
+    self.__make_page_info = make_page_info
+    self.__page_infos = {}
 
-      x = self._rect.get_property('x')
-      y = self._rect.get_property('y')
-      w = self._rect.get_property('width')
-      h = self._rect.get_property('height')
-      dx = event.x - self.__drag_x
-      dy = event.y - self.__drag_y
-      if self._sync_to_cropping_box(x, y, w, h, dx, dy):
-        for listener in self._dx_listeners:
-          listener.props.x = listener.props.x + dx
-        for listener in self._dx2_listeners:
-          listener.props.x = listener.props.x + dx/2.0
-        for listener in self._dy_listeners:
-          listener.props.y = listener.props.y + dy
-        for listener in self._dy2_listeners:
-          listener.props.y = listener.props.y + dy/2.0
-        for listener in self._dxdy_listeners:
-          listener.props.x = listener.props.x + dx
-          listener.props.y = listener.props.y + dy
-        for listener in self._dx2dy_listeners:
-          listener.props.x = listener.props.x + dx/2.0
-          listener.props.y = listener.props.y + dy
-        for listener in self._dxdy2_listeners:
-          listener.props.x = listener.props.x + dx
-          listener.props.y = listener.props.y + dy/2.0
-      self.__drag_x = event.x
-      self.__drag_y = event.y
 
-    return True
+  def __len__(self):
+    return self.__n_pages
 
 
-  def __on_button_press(self, item, target, event):
-    if event.button == 1:
-      self.__drag_x = event.x
-      self.__drag_y = event.y
-      item.get_canvas().pointer_grab(
-          item,
-          Gdk.EventMask.POINTER_MOTION_MASK | Gdk.EventMask.BUTTON_RELEASE_MASK,
-          self._cursor,
-          event.time)
-      self.__dragging = True
+  def page_info(self, pagenum):
+    page_info = self.__page_infos.get(pagenum)
+    if page_info is None:
+      page_info = self.__make_page_info(pagenum)
+      self.__page_infos[pagenum] = page_info
+    return page_info
 
-    return True
 
+  def __iter_for(self, index):
+    if 0 <= index < self.__n_pages:
+      tree_iter = Gtk.TreeIter()
+      # user_data is a pointer, keep it away from NULL.
+      tree_iter.user_data = index + 1
+      return (True, tree_iter)
+    return (False, None)
 
-  def __on_button_release(self, item, target, event):
-    canvas = item.get_canvas()
-    canvas.pointer_ungrab(item, event.time)
-    page_info = canvas.page_info
-    crop_setting = page_info.crop_setting
-    crop_setting['x'] = self._rect.props.x
-    crop_setting['y'] = self._rect.props.y
-    crop_setting['w'] = self._rect.props.width
-    crop_setting['h'] = self._rect.props.height
-    self.__dragging = False
 
+  def do_get_flags(self):
+    return Gtk.TreeModelFlags.LIST_ONLY | Gtk.TreeModelFlags.ITERS_PERSIST
 
-  def __on_mouse_enter(self, item, target, event):
-    item.get_canvas().get_window().set_cursor(self._cursor)
 
+  def do_get_n_columns(self):
+    return 2
 
-  def __on_mouse_leave(self, item, target, event):
-    item.get_canvas().get_window().set_cursor(None)
 
+  def do_get_column_type(self, column):
+    return (GObject.TYPE_STRING, GObject.TYPE_PYOBJECT)[column]
 
-class UResizer(Resizer):
-  def __init__(self, parent, rect, x, y):
-    Resizer.__init__(self, parent, rect, x, y)
-    self._dy_listeners.append(self)
-    self._cursor = Gdk.Cursor(Gdk.CursorType.TOP_SIDE)
 
+  def do_get_iter(self, path):
+    indices = path.get_indices()
+    if len(indices) != 1:
+      return (False, None)
+    return self.__iter_for(indices[0])
 
-  def sync_from_cropping_box(self, x0, y0, x1, y1):
-    self.set_property('center-x', (x0 + x1) / 2.0)
-    self.set_property('center-y', y0)
 
+  def do_get_path(self, tree_iter):
+    return Gtk.TreePath((tree_iter.user_data - 1,))
 
-  def _sync_to_cropping_box(self, x, y, w, h, dx, dy):
-    hh = h - dy
-    if hh > 50 or hh > h:
-      self._rect.set_property('y', y + dy)
-      self._rect.set_property('height', hh)
-      return True
 
-    return False
+  def do_get_value(self, tree_iter, column):
+    index = tree_iter.user_data - 1
+    if column == 0:
+      return str(index + 1)
+    return self.page_info(index)
 
 
-class RResizer(Resizer):
-  def __init__(self, parent, rect, x, y):
-    Resizer.__init__(self, parent, rect, x, y)
-    self._dx_listeners.append(self)
-    self._cursor = Gdk.Cursor(Gdk.CursorType.RIGHT_SIDE)
+  def do_iter_next(self, tree_iter):
+    return self.__iter_for(tree_iter.user_data)
 
 
-  def sync_from_cropping_box(self, x0, y0, x1, y1):
-    self.set_property('center-x', x1)
-    self.set_property('center-y', (y0 + y1) / 2.0)
+  def do_iter_previous(self, tree_iter):
+    return self.__iter_for(tree_iter.user_data - 2)
 
 
-  def _sync_to_cropping_box(self, x, y, w, h, dx, dy):
-    ww = w + dx
-    if ww > 50 or ww > w:
-      self._rect.set_property('width', ww)
-      return True
+  def do_iter_children(self, parent):
+    if parent is None:
+      return self.__iter_for(0)
+    return (False, None)
 
-    return False
 
+  def do_iter_has_child(self, tree_iter):
+    return False
 
-class BResizer(Resizer):
-  def __init__(self, parent, rect, x, y):
-    Resizer.__init__(self, parent, rect, x, y)
-    self._dy_listeners.append(self)
-    self._cursor = Gdk.Cursor(Gdk.CursorType.BOTTOM_SIDE)
 
+  def do_iter_n_children(self, tree_iter):
+    if tree_iter is None:
+      return self.__n_pages
+    return 0
+
+
+  def do_iter_nth_child(self, parent, n):
+    if parent is None:
+      return self.__iter_for(n)
+    return (False, None)
+
+
+  def do_iter_parent(self, child):
+    return (False, None)
+
+
+def new_page_surface(w, h, gray):
+  if gray:
+    # Grayscale pages are rendered opaque over white, then collapsed to one
+    # byte per pixel by gray_surface().
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, w, h)
+    context = cairo.Context(surface)
+    context.set_source_rgb(1, 1, 1)
+    context.paint()
+  else:
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+    context = cairo.Context(surface)
+  return surface, context
+
+
+def gray_surface(surface):
+  # Turns an RGB24 rendering of a grayscale page into an A8 surface holding
+  # the ink coverage (255 - luminance), a quarter of the memory. It is
+  # painted back as a black mask over white, see paint_surface().
+  if numpy is None:
+    return surface
+  surface.flush()
+  w, h = surface.get_width(), surface.get_height()
+  pixels = numpy.ndarray((h, surface.get_stride() // 4), numpy.uint32,
+                         buffer=surface.get_data())[:, :w]
+  stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_A8, w)
+  coverage = numpy.zeros((h, stride), numpy.uint8)
+  # R, G and B are equal on grayscale pages, the green byte will do.
+  coverage[:, :w] = 255 - ((pixels >> 8) & 0xff).astype(numpy.uint8)
+  return cairo.ImageSurface.create_for_data(
+      coverage, cairo.FORMAT_A8, w, h, stride)
+
+
+def is_grayscale(surface):
+  surface.flush()
+  w = surface.get_width()
+  pixels = numpy.ndarray((surface.get_height(), surface.get_stride() // 4),
+                         numpy.uint32, buffer=surface.get_data())[:, :w]
+  r = (pixels >> 16) & 0xff
+  g = (pixels >> 8) & 0xff
+  b = pixels & 0xff
+  return bool(numpy.array_equal(r, g) and numpy.array_equal(g, b))
+
+
+def render_opaque(document, pagenum, scale):
+  # Renders a page opaque over white like grayscale pages, but kept in color.
+  # Returns the surface and its pixels per PDF point.
+  with POPPLER_LOCK:
+    page = document.get_page(pagenum)
+    w, h, ratio = page_pixel_size(page, scale)
+    surface, context = new_page_surface(w, h, True)
+    context.scale(ratio, ratio)
+    page.render(context)
+  surface.flush()
+  return surface, ratio
+
+
+def ink_coverage(surface):
+  # The ink of an RGB24 surface rendered over white, as 255 minus the darkest
+  # channel so that colored ink counts as well. The pixels are read in place,
+  # through an array over the surface data.
+  w = surface.get_width()
+  pixels = numpy.ndarray((surface.get_height(), surface.get_stride() // 4),
+                         numpy.uint32, buffer=surface.get_data())[:, :w]
+  darkest = numpy.minimum(numpy.minimum((pixels >> 16) & 0xff,
+                                        (pixels >> 8) & 0xff),
+                          pixels & 0xff)
+  return (255 - darkest).astype(numpy.uint8)
+
+
+def ink_bounds(coverage, threshold=AUTOCROP_THRESHOLD, min_ink=AUTOCROP_MIN_INK):
+  # Bounding box (x, y, w, h), in pixels, of the ink of an ink_coverage(), or
+  # None if there is none.
+  ink = coverage > threshold
+  rows = numpy.flatnonzero(numpy.count_nonzero(ink, axis=1) >= min_ink)
+  columns = numpy.flatnonzero(numpy.count_nonzero(ink, axis=0) >= min_ink)
+  if not len(rows) or not len(columns):
+    return None
+  return (int(columns[0]), int(rows[0]),
+          int(columns[-1] - columns[0]) + 1, int(rows[-1] - rows[0]) + 1)
+
+
+def auto_crop(document, pagenum, margin=AUTOCROP_MARGIN):
+  # The box around the ink of a page in PDF points, padded by margin and
+  # clipped to the page, or None for a blank page.
+  with POPPLER_LOCK:
+    page_width, page_height = document.get_page(pagenum).get_size()
+  surface, ratio = render_opaque(document, pagenum, AUTOCROP_SCALE)
+  bounds = ink_bounds(ink_coverage(surface))
+  if bounds is None:
+    return None
+  x, y, w, h = [value / ratio for value in bounds]
+  x0, y0 = max(x - margin, 0.0), max(y - margin, 0.0)
+  x1 = min(x + w + margin, page_width)
+  y1 = min(y + h + margin, page_height)
+  return x0, y0, x1 - x0, y1 - y0
+
+
+def layout_crop(document, pagenum, margin=AUTOCROP_MARGIN):
+  # The box around the content of a page in PDF points, padded by margin and
+  # clipped to the page, from the text layout and the image and annotation
+  # mappings of the page: no rendering needed. Returns None for pages whose
+  # content only a rendering shows: pages without text, like drawings, and
+  # pages mostly covered by images, like scans with an OCR text layer.
+  with POPPLER_LOCK:
+    page = document.get_page(pagenum)
+    page_width, page_height = page.get_size()
+    found, rectangles = page.get_text_layout()
+    if not found or not rectangles:
+      return None
+    images = [(m.area.x1, m.area.y1, m.area.x2, m.area.y2)
+              for m in page.get_image_mapping()]
+    covered = sum(abs((x2 - x1) * (y2 - y1)) for x1, y1, x2, y2 in images)
+    if covered > LAYOUT_IMAGE_COVERAGE * page_width * page_height:
+      return None
+    areas = [(r.x1, r.y1, r.x2, r.y2) for r in rectangles]
+    areas.extend(images)
+    areas.extend((m.area.x1, m.area.y1, m.area.x2, m.area.y2)
+                 for m in page.get_annot_mapping())
+  edges = numpy.array(areas)
+  # Corners do not always come in order.
+  x0 = min(edges[:, 0].min(), edges[:, 2].min())
+  y0 = min(edges[:, 1].min(), edges[:, 3].min())
+  x1 = max(edges[:, 0].max(), edges[:, 2].max())
+  y1 = max(edges[:, 1].max(), edges[:, 3].max())
+  x0, y0 = max(float(x0) - margin, 0.0), max(float(y0) - margin, 0.0)
+  x1 = min(float(x1) + margin, page_width)
+  y1 = min(float(y1) + margin, page_height)
+  if x1 <= x0 or y1 <= y0:
+    return None
+  return x0, y0, x1 - x0, y1 - y0
+
+
+def content_crop(document, pagenum):
+  # Crop suggestion for a page from its layout when it has one, otherwise
+  # from a rendering. Figures drawn only with paths are not in the layout,
+  # so this quick pass is only used when asked for.
+  crop = layout_crop(document, pagenum)
+  if crop is None:
+    crop = auto_crop(document, pagenum)
+  return crop
+
+
+# Page functions run by the processes of a PageTask, on the document of the
+# process.
+def page_task_init(filename):
+  global PAGE_TASK_DOCUMENT
+  PAGE_TASK_DOCUMENT = Poppler.Document.new_from_file('file://%s' % filename,
+                                                      None)
+
+
+def auto_crop_page(pagenum):
+  return auto_crop(PAGE_TASK_DOCUMENT, pagenum)
+
+
+def layout_crop_page(pagenum):
+  return content_crop(PAGE_TASK_DOCUMENT, pagenum)
+
+
+def ghost_page(pagenum):
+  surface, _ = render_opaque(PAGE_TASK_DOCUMENT, pagenum, GHOST_SCALE)
+  return ink_coverage(surface)
+
+
+def crop_groups(boxes):
+  # Splits the auto-crop boxes of all the pages (None for blank pages) into
+  # the box of the odd pages, that of the even pages, and a dict of the
+  # pages set apart with their own box. A page is set apart when its box
+  # reaches out beyond the median box of its group by more than
+  # CROP_OUTLIER_POINTS, the 1-st and 2-nd pages too, like a full-bleed
+  # cover.
+  groups = []
+  overrides = {}
+  for first in (0, 1):
+    pagenums = [pagenum for pagenum in range(first, len(boxes), 2)
+                if boxes[pagenum] is not None]
+    if not pagenums:
+      groups.append(None)
+      continue
+    edges = numpy.array([boxes[pagenum] for pagenum in pagenums])
+    edges[:, 2:] += edges[:, :2]
+    median = numpy.median(edges, axis=0)
+    outliers = ((edges[:, :2] < median[:2] - CROP_OUTLIER_POINTS).any(axis=1) |
+                (edges[:, 2:] > median[2:] + CROP_OUTLIER_POINTS).any(axis=1))
+    # When no page sits within the median box, as with a blank 2-nd page
+    # and the others reaching out on opposite sides, the page nearest to
+    # it gives the group its box.
+    if outliers.all():
+      outliers[numpy.abs(edges - median).sum(axis=1).argmin()] = False
+    for pagenum in numpy.array(pagenums)[outliers]:
+      overrides[int(pagenum)] = boxes[pagenum]
+    inliers = edges[~outliers]
+    x0, y0 = inliers[:, :2].min(axis=0)
+    x1, y1 = inliers[:, 2:].max(axis=0)
+    groups.append((float(x0), float(y0), float(x1 - x0), float(y1 - y0)))
+  return groups[0], groups[1], overrides
+
+
+def kmeans(features, k, iterations=CLUSTER_ITERATIONS):
+  # Labels the rows of features with k clusters, and returns the labels and
+  # the cluster centers. Starts from the farthest-first traversal of the
+  # rows, so the result is repeatable and odd rows get a cluster early on.
+  centers = numpy.empty((k, features.shape[1]))
+  centers[0] = numpy.median(features, axis=0)
+  distances = ((features - centers[0]) ** 2).sum(axis=1)
+  for i in range(1, k):
+    centers[i] = features[distances.argmax()]
+    distances = numpy.minimum(distances,
+                              ((features - centers[i]) ** 2).sum(axis=1))
+
+  labels = None
+  for _ in range(iterations):
+    distances = ((features[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+    new_labels = distances.argmin(axis=1)
+    if labels is not None and numpy.array_equal(labels, new_labels):
+      break
+    labels = new_labels
+    counts = numpy.bincount(labels, minlength=k)
+    sums = numpy.zeros_like(centers)
+    numpy.add.at(sums, labels, features)
+    filled = counts > 0
+    centers[filled] = sums[filled] / counts[filled, None]
+  return labels, centers
+
+
+def cluster_pages(boxes, sizes):
+  # Groups pages with alike content boxes and page sizes; boxes lists the
+  # crop suggestion of every page (None for blank pages) and sizes the page
+  # sizes. Returns the union of the boxes and the pages of every group.
+  # Blank pages are in no group.
+  pagenums = numpy.array([pagenum for pagenum, box in enumerate(boxes)
+                          if box is not None], int)
+  if not len(pagenums):
+    return []
+  edges = numpy.array([boxes[pagenum] for pagenum in pagenums], float)
+  edges[:, 2:] += edges[:, :2]
+  features = numpy.hstack(
+      (edges, numpy.array([sizes[pagenum] for pagenum in pagenums], float)))
+
+  # As few groups as will keep every page close to the typical page of its
+  # group.
+  for k in range(1, min(CROP_CLUSTERS, len(pagenums)) + 1):
+    labels, centers = kmeans(features, k)
+    if numpy.abs(features - centers[labels]).max() <= CROP_OUTLIER_POINTS:
+      break
+
+  clusters = []
+  for label in numpy.unique(labels):
+    members = labels == label
+    x0, y0 = edges[members, :2].min(axis=0)
+    x1, y1 = edges[members, 2:].max(axis=0)
+    clusters.append(((float(x0), float(y0), float(x1 - x0), float(y1 - y0)),
+                     pagenums[members].tolist()))
+  return clusters
+
+
+# Runs func(pagenum), a module function, on pages of a document with a pool
+# of processes, each with a Poppler document of its own. A background thread
+# feeds the pool and hands each result to on_result(pagenum, result) as it
+# comes in. on_progress(text, fraction) and then on_done(completed) are
+# called on the GTK main loop; completed is False if cancelled or failed.
+class PageTask(object):
+  def __init__(self, filename, pagenums, func, text, on_result, on_progress,
+               on_done):
+    self.__filename = filename
+    self.__pagenums = pagenums
+    self.__func = func
+    self.__text = text
+    self.__on_result = on_result
+    self.__on_progress = on_progress
+    self.__on_done = on_done
+    self.cancelled = False
+    thread = threading.Thread(target=self.__run, name='page-task')
+    thread.daemon = True
+    thread.start()
+
+
+  def __run(self):
+    completed = False
+    try:
+      completed = self.__map()
+    except Exception:
+      traceback.print_exc()
+    GLib.idle_add(self.__deliver, completed)
+
+
+  def __map(self):
+    n_pages = len(self.__pagenums)
+    # Forked children would inherit the GTK and Poppler state of this
+    # process, spawned ones start clean.
+    pool = multiprocessing.get_context('spawn').Pool(
+        PAGE_TASK_PROCESSES, page_task_init, (self.__filename,))
+    try:
+      percent = None
+      results = pool.imap_unordered(PageCall(self.__func), self.__pagenums,
+                                    PAGE_TASK_CHUNK)
+      for done, (pagenum, result) in enumerate(results, 1):
+        if self.cancelled:
+          return False
+        self.__on_result(pagenum, result)
+        if done * 100 // n_pages != percent:
+          percent = done * 100 // n_pages
+          GLib.idle_add(self.__on_progress,
+                        '%s: %d / %d' % (self.__text, done, n_pages),
+                        float(done) / n_pages)
+    finally:
+      pool.terminate()
+      pool.join()
+    return True
 
-  def sync_from_cropping_box(self, x0, y0, x1, y1):
-    self.set_property('center-x', (x0 + x1) / 2.0)
-    self.set_property('center-y', y1)
 
+  def __deliver(self, completed):
+    self.__on_done(completed and not self.cancelled)
+    return False
 
-  def _sync_to_cropping_box(self, x, y, w, h, dx, dy):
-    hh = h + dy
-    if hh > 50 or hh > h:
-      self._rect.set_property('height', hh)
-      return True
 
-    return False
+# Pairs the result of a page function with its page, the results of the
+# pool come back out of order.
+class PageCall(object):
+  def __init__(self, func):
+    self.func = func
+
+
+  def __call__(self, pagenum):
+    return pagenum, self.func(pagenum)
+
+
+# Superimposes the ink coverage of pages: the largest and the total coverage
+# of every pixel, at GHOST_SCALE. Pages are added from a background thread
+# while the main loop takes surfaces() of what has been added so far.
+class GhostImage(object):
+  def __init__(self, width, height):
+    w = int(int(width) * GHOST_SCALE)
+    h = int(int(height) * GHOST_SCALE)
+    self.__max = numpy.zeros((h, w), numpy.uint8)
+    self.__sum = numpy.zeros((h, w), numpy.uint32)
+    self.__count = 0
+    self.__lock = threading.Lock()
+
+
+  def add(self, coverage):
+    # Pages are aligned on their top left corner, like their crops.
+    h = min(coverage.shape[0], self.__max.shape[0])
+    w = min(coverage.shape[1], self.__max.shape[1])
+    coverage = coverage[:h, :w]
+    with self.__lock:
+      numpy.maximum(self.__max[:h, :w], coverage, out=self.__max[:h, :w])
+      self.__sum[:h, :w] += coverage
+      self.__count += 1
+
+
+  def surfaces(self):
+    # A8 surfaces of the largest and of the mean coverage, or None if no
+    # page has been added yet.
+    with self.__lock:
+      if not self.__count:
+        return None
+      largest = self.__max.copy()
+      mean = (self.__sum // self.__count).astype(numpy.uint8)
+    return a8_surface(largest), a8_surface(mean)
+
+
+def a8_surface(values):
+  h, w = values.shape
+  stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_A8, w)
+  data = numpy.zeros((h, stride), numpy.uint8)
+  data[:, :w] = values
+  return cairo.ImageSurface.create_for_data(data, cairo.FORMAT_A8, w, h,
+                                            stride)
+
+
+def paint_ghost(cr, ghost, ratio):
+  # Paints a pair of GhostImage surfaces in red over a page, scaled by ratio:
+  # lightly where any page has ink, darker where most pages do.
+  largest, mean = ghost
+  cr.save()
+  cr.scale(ratio, ratio)
+  cr.set_source_rgba(0.9, 0.1, 0.1, 0.3)
+  cr.mask_surface(largest, 0, 0)
+  cr.set_source_rgba(0.7, 0.0, 0.0, 0.6)
+  cr.mask_surface(mean, 0, 0)
+  cr.restore()
+
+
+def paint_surface(cr, surface, x=0, y=0):
+  if surface.get_format() == cairo.FORMAT_A8:
+    cr.set_source_rgb(1, 1, 1)
+    cr.rectangle(x, y, surface.get_width(), surface.get_height())
+    cr.fill()
+    cr.set_source_rgb(0, 0, 0)
+    cr.mask_surface(surface, x, y)
+  else:
+    cr.set_source_surface(surface, x, y)
+    cr.paint()
+
+
+def render_page(document, pagenum, scale, max_bytes=None, gray=False):
+  with POPPLER_LOCK:
+    page = document.get_page(pagenum)
+    w, h, ratio = page_pixel_size(page, scale)
+    if max_bytes is not None and w * h * 4 > max_bytes:
+      # Too large for a single bitmap, the caller has to render tiles.
+      return None, w, h
+    # Render to a pixmap
+    surface, context = new_page_surface(w, h, gray)
+    context.scale(ratio, ratio)
+    page.render(context)
+  if gray:
+    surface = gray_surface(surface)
+  return surface, w, h
+
+
+def render_tile(document, pagenum, scale, x, y, w, h, gray=False):
+  with POPPLER_LOCK:
+    page = document.get_page(pagenum)
+    _, _, ratio = page_pixel_size(page, scale)
+    surface, context = new_page_surface(w, h, gray)
+    context.translate(-x, -y)
+    context.scale(ratio, ratio)
+    page.render(context)
+  if gray:
+    surface = gray_surface(surface)
+  return surface
+
+
+def render_thumbnail(document, pagenum, size):
+  with POPPLER_LOCK:
+    page = document.get_page(pagenum)
+    page_width, page_height = page.get_size()
+    ratio = float(size) / max(page_width, page_height)
+    w, h = max(1, int(page_width * ratio)), max(1, int(page_height * ratio))
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+    context = cairo.Context(surface)
+    context.set_source_rgb(1, 1, 1)
+    context.paint()
+    context.scale(ratio, ratio)
+    page.render(context)
+  return surface
+
+
+def surface_nbytes(surface):
+  return surface.get_stride() * surface.get_height()
+
+
+def file_identity(filename):
+  # Identifies a version of a file for the on-disk cache.
+  st = os.stat(filename)
+  return (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+
+
+def cache_directory():
+  return os.path.join(
+      os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+      'pdf-quench')
+
+
+# LRU cache of rendered surfaces in files, bounded by the total size of the
+# files. The access time of an entry is tracked by its file mtime, so the
+# order survives restarts. Errors are ignored, the cache is just skipped.
+class DiskCache(object):
+  HEADER = struct.Struct('<4i')
+
+  def __init__(self, directory, max_bytes):
+    self.__lock = threading.Lock()
+    self.__directory = directory
+    self.__max_bytes = max_bytes
+    self.__nbytes = None
+
+
+  def __path(self, key):
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    return os.path.join(self.__directory, digest + '.surface')
+
+
+  def get(self, key):
+    path = self.__path(key)
+    try:
+      with open(path, 'rb') as fh:
+        data = fh.read()
+      os.utime(path, None)
+      fmt, w, h, stride = self.HEADER.unpack_from(data)
+      pixels = bytearray(zlib.decompress(data[self.HEADER.size:]))
+      return cairo.ImageSurface.create_for_data(
+          pixels, cairo.Format(fmt), w, h, stride)
+    except (IOError, OSError, ValueError, struct.error, zlib.error):
+      return None
+
+
+  def put(self, key, surface):
+    surface.flush()
+    data = (self.HEADER.pack(int(surface.get_format()), surface.get_width(),
+                             surface.get_height(), surface.get_stride()) +
+            zlib.compress(bytes(surface.get_data()), 1))
+    path = self.__path(key)
+    try:
+      with self.__lock:
+        if self.__nbytes is None:
+          if not os.path.isdir(self.__directory):
+            os.makedirs(self.__directory)
+          self.__nbytes = sum(size for _, size, _ in self.__entries())
+        tmp_path = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp_path, 'wb') as fh:
+          fh.write(data)
+        os.replace(tmp_path, path)
+        self.__nbytes += len(data)
+        if self.__nbytes > self.__max_bytes:
+          self.__evict()
+    except (IOError, OSError):
+      pass
+
+
+  def __entries(self):
+    for name in os.listdir(self.__directory):
+      if name.endswith('.surface'):
+        path = os.path.join(self.__directory, name)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        yield path, st.st_size, st.st_mtime
+
+
+  def __evict(self):
+    # Remove the least recently used files down to 90% of the budget, so
+    # that the directory is not scanned again on every write.
+    entries = sorted(self.__entries(), key=lambda entry: entry[2])
+    self.__nbytes = sum(size for _, size, _ in entries)
+    for path, size, _ in entries:
+      if self.__nbytes <= self.__max_bytes * 0.9:
+        break
+      try:
+        os.remove(path)
+        self.__nbytes -= size
+      except OSError:
+        pass
+
+
+# LRU cache of rendered pages, bounded by the memory held by the cached
+# bitmaps. It is shared by the main loop and the render worker.
+class RenderCache(object):
+  def __init__(self, max_bytes):
+    self.__lock = threading.Lock()
+    self.__entries = OrderedDict()
+    self.__max_bytes = max_bytes
+    self.__nbytes = 0
+    self.hits = 0
+    self.misses = 0
+
+
+  def __len__(self):
+    return len(self.__entries)
+
+
+  def __contains__(self, key):
+    with self.__lock:
+      return key in self.__entries
 
 
-class LResizer(Resizer):
-  def __init__(self, parent, rect, x, y):
-    Resizer.__init__(self, parent, rect, x, y)
-    self._dx_listeners.append(self)
-    self._cursor = Gdk.Cursor(Gdk.CursorType.LEFT_SIDE)
+  @property
+  def nbytes(self):
+    return self.__nbytes
 
+  @property
+  def max_bytes(self):
+    return self.__max_bytes
+
+
+  def get(self, key):
+    with self.__lock:
+      entry = self.__entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      self.__entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+
+  def peek(self, key):
+    # Like get(), but neither refreshes the entry nor counts a hit or miss.
+    with self.__lock:
+      entry = self.__entries.get(key)
+      return entry[0] if entry is not None else None
+
+
+  def put(self, key, value, nbytes):
+    with self.__lock:
+      old = self.__entries.pop(key, None)
+      if old is not None:
+        self.__nbytes -= old[1]
+      self.__entries[key] = (value, nbytes)
+      self.__nbytes += nbytes
+      # Always keep the newest entry, even if it alone exceeds the budget.
+      while self.__nbytes > self.__max_bytes and len(self.__entries) > 1:
+        _, (_, size) = self.__entries.popitem(last=False)
+        self.__nbytes -= size
+
+
+  def clear(self):
+    with self.__lock:
+      self.__entries.clear()
+      self.__nbytes = 0
+
+
+class RenderJob(object):
+  def __init__(self, kind, func, callback=None, priority=0):
+    self.kind = kind
+    self.func = func
+    self.callback = callback
+    self.priority = priority
+    self.cancelled = False
+
+
+# Runs render jobs in a background thread. Jobs are taken in priority order
+# (lowest first) and their results are handed to the job callback on the GTK
+# main loop. A cancelled job is skipped if still queued, and its result is
+# dropped if it is already running or waiting to be delivered.
+class RenderWorker(object):
+  def __init__(self):
+    self.__cond = threading.Condition()
+    self.__queue = []
+    self.__counter = itertools.count()
+    self.__current = None
+    # Jobs done whose result is waiting for the main loop.
+    self.__delivering = set()
+    thread = threading.Thread(target=self.__run, name='render-worker')
+    thread.daemon = True
+    thread.start()
+
+
+  def submit(self, job):
+    with self.__cond:
+      heapq.heappush(self.__queue, (job.priority, next(self.__counter), job))
+      self.__cond.notify()
+    return job
+
+
+  def cancel(self, kind=None):
+    with self.__cond:
+      for _, _, job in self.__queue:
+        if kind is None or job.kind == kind:
+          job.cancelled = True
+      self.__queue = [entry for entry in self.__queue if not entry[2].cancelled]
+      heapq.heapify(self.__queue)
+      job = self.__current
+      if job is not None and (kind is None or job.kind == kind):
+        job.cancelled = True
+      for job in self.__delivering:
+        if kind is None or job.kind == kind:
+          job.cancelled = True
+
+
+  def __run(self):
+    while True:
+      with self.__cond:
+        while not self.__queue:
+          self.__cond.wait()
+        _, _, job = heapq.heappop(self.__queue)
+        if job.cancelled:
+          continue
+        self.__current = job
+
+      try:
+        result = job.func()
+      except Exception:
+        traceback.print_exc()
+        job.cancelled = True
+        result = None
+
+      with self.__cond:
+        self.__current = None
+        if job.callback and not job.cancelled:
+          self.__delivering.add(job)
+          GLib.idle_add(self.__deliver, job, result)
+
+
+  def __deliver(self, job, result):
+    with self.__cond:
+      self.__delivering.discard(job)
+    if not job.cancelled:
+      job.callback(result)
+    return False
 
-  def sync_from_cropping_box(self, x0, y0, x1, y1):
-    self.set_property('center-x', x0)
-    self.set_property('center-y', (y0 + y1) / 2.0)
 
+# Coalesces pointer motion to one update per frame. Motion events only
+# record the pointer position, and the last one is handed to the callback
+# from the GDK frame clock, before the canvas is painted.
+class MotionCoalescer(object):
+  def __init__(self, callback):
+    self.__callback = callback
+    self.__position = None
+    self.__widget = None
+    self.__tick_id = None
 
-  def _sync_to_cropping_box(self, x, y, w, h, dx, dy):
-    ww = w - dx
-    if ww > 50 or ww > w:
-      self._rect.set_property('x', x + dx)
-      self._rect.set_property('width', ww)
-      return True
 
-    return False
+  def push(self, widget, x, y):
+    self.__position = (x, y)
+    if self.__tick_id is None:
+      self.__widget = widget
+      self.__tick_id = widget.add_tick_callback(self.__on_tick)
 
 
-class ULResizer(Resizer):
-  def __init__(self, parent, rect, x, y):
-    Resizer.__init__(self, parent, rect, x, y)
-    self._dxdy_listeners.append(self)
-    self._cursor = Gdk.Cursor(Gdk.CursorType.TOP_LEFT_CORNER)
+  def flush(self):
+    # Applies the pending position right away, e.g. on button release.
+    if self.__tick_id is not None:
+      self.__widget.remove_tick_callback(self.__tick_id)
+      self.__tick_id = None
+    self.__apply()
 
 
-  def sync_from_cropping_box(self, x0, y0, x1, y1):
-    self.set_property('center-x', x0)
-    self.set_property('center-y', y0)
+  def __on_tick(self, widget, frame_clock):
+    self.__tick_id = None
+    self.__apply()
+    return False
 
 
-  def _sync_to_cropping_box(self, x, y, w, h, dx, dy):
-    ww = w - dx
-    hh = h - dy
-    if (ww > 50 or ww > w) and (hh > 50 or hh > h):
-      self._rect.set_property('x', x + dx)
-      self._rect.set_property('y', y + dy)
-      self._rect.set_property('width', ww)
-      self._rect.set_property('height', hh)
-      return True
+  def __apply(self):
+    position, self.__position = self.__position, None
+    if position is not None:
+      self.__callback(*position)
 
-    return False
 
+def store_crop(slot, x, y, w, h):
+  # Canvas units are PDF points times the canvas scale.
+  scale = slot.get_canvas().get_scale()
+  slot.page_info.set_crop(x / scale, y / scale, w / scale, h / scale)
+  if slot.on_crop_changed:
+    slot.on_crop_changed()
 
-class URResizer(Resizer):
-  def __init__(self, parent, rect, x, y):
-    Resizer.__init__(self, parent, rect, x, y)
-    self._dxdy_listeners.append(self)
-    self._cursor = Gdk.Cursor(Gdk.CursorType.TOP_RIGHT_CORNER)
 
+# A handle on the edge or corner of a cropping box. Its anchor gives its
+# position on the box as fractions (0, 0.5 or 1) of the box width and height,
+# which is also which edges it moves.
+class Resizer(GooCanvas.CanvasEllipse):
+  def __init__(self, box, anchor, cursor_type):
+    self._box = box
+    self._anchor = anchor
+    GooCanvas.CanvasEllipse.__init__(self,
+                                     parent=box,
+                                     center_x=0,
+                                     center_y=0,
+                                     radius_x=5,
+                                     radius_y=5,
+                                     stroke_color="red",
+                                     fill_color="blue",
+                                     line_width=1.0)
+    self.connect("motion_notify_event", self.__on_motion_notify)
+    self.connect("button_press_event", self.__on_button_press)
+    self.connect("button_release_event", self.__on_button_release)
+    self.connect("enter_notify_event", self.__on_mouse_enter)
+    self.connect("leave_notify_event", self.__on_mouse_leave)
+    self.__dragging = False
+    self.__drag_geometry = None
+    self.__motion = MotionCoalescer(self.__drag_to)
+    self._cursor = Gdk.Cursor(cursor_type)
 
-  def sync_from_cropping_box(self, x0, y0, x1, y1):
-    self.set_property('center-x', x1)
-    self.set_property('center-y', y0)
 
+  def place(self, w, h):
+    fx, fy = self._anchor
+    self.set_simple_transform(fx * w, fy * h, 1.0, 0.0)
 
-  def _sync_to_cropping_box(self, x, y, w, h, dx, dy):
-    ww = w + dx
-    hh = h - dy
-    if (ww > 50 or ww > w) and (hh > 50 or hh > h):
-      self._rect.set_property('y', y + dy)
-      self._rect.set_property('width', ww)
-      self._rect.set_property('height', hh)
-      return True
 
-    return False
+  def resize(self, x, y, w, h, dx, dy):
+    # The box geometry after dragging this handle by dx, dy, or None when
+    # that would shrink the box under 50 units.
+    fx, fy = self._anchor
+    if fx == 0:
+      x, w, ww = x + dx, w - dx, w
+    elif fx == 1:
+      w, ww = w + dx, w
+    else:
+      ww = w
+    if fy == 0:
+      y, h, hh = y + dy, h - dy, h
+    elif fy == 1:
+      h, hh = h + dy, h
+    else:
+      hh = h
+    if (w > 50 or w > ww) and (h > 50 or h > hh):
+      return x, y, w, h
+    return None
 
 
-class BLResizer(Resizer):
-  def __init__(self, parent, rect, x, y):
-    Resizer.__init__(self, parent, rect, x, y)
-    self._dxdy_listeners.append(self)
-    self._cursor = Gdk.Cursor(Gdk.CursorType.BOTTOM_LEFT_CORNER)
+  def __on_motion_notify(self, item, target, event):
+    if self.__dragging and (event.state & Gdk.ModifierType.BUTTON1_MASK):
+      # x_root and y_root are in canvas space, x and y in item space.
+      self.__motion.push(item.get_canvas(), event.x_root, event.y_root)
+    return True
 
 
-  def sync_from_cropping_box(self, x0, y0, x1, y1):
-    self.set_property('center-x', x0)
-    self.set_property('center-y', y1)
+  def __drag_to(self, event_x, event_y):
+    if self.__dragging:
+      # don't allow it move out of page
+      bound = self._box.slot.region
+      if (event_x < bound.x or
+          event_y < bound.y or
+          event_x > bound.x + bound.width or
+          event_y > bound.y + bound.height):
+        return
 
+      geometry = self.resize(*(self.__drag_geometry +
+                               (event_x - self.__drag_x,
+                                event_y - self.__drag_y)))
+      if geometry:
+        self._box.set_geometry(*geometry)
 
-  def _sync_to_cropping_box(self, x, y, w, h, dx, dy):
-    ww = w - dx
-    hh = h + dy
-    if (ww > 50 or ww > w) and (hh > 50 or hh > h):
-      self._rect.set_property('x', x + dx)
-      self._rect.set_property('width', ww)
-      self._rect.set_property('height', hh)
-      return True
 
-    return False
+  def __on_button_press(self, item, target, event):
+    if event.button == 1:
+      self.__drag_x = event.x_root
+      self.__drag_y = event.y_root
+      self.__drag_geometry = self._box.geometry
+      item.get_canvas().pointer_grab(
+          item,
+          Gdk.EventMask.POINTER_MOTION_MASK | Gdk.EventMask.BUTTON_RELEASE_MASK,
+          self._cursor,
+          event.time)
+      self.__dragging = True
 
+    return True
 
-class BRResizer(Resizer):
-  def __init__(self, parent, rect, x, y):
-    Resizer.__init__(self, parent, rect, x, y)
-    self._dxdy_listeners.append(self)
-    self._cursor = Gdk.Cursor(Gdk.CursorType.BOTTOM_RIGHT_CORNER)
 
+  def __on_button_release(self, item, target, event):
+    item.get_canvas().pointer_ungrab(item, event.time)
+    self.__motion.flush()
+    # A click without a drag leaves an inherited crop alone.
+    if self.__dragging and self._box.geometry != self.__drag_geometry:
+      store_crop(self._box.slot, *self._box.geometry)
+    self.__dragging = False
+    return True
 
-  def sync_from_cropping_box(self, x0, y0, x1, y1):
-    self.set_property('center-x', x1)
-    self.set_property('center-y', y1)
 
+  def __on_mouse_enter(self, item, target, event):
+    item.get_canvas().get_window().set_cursor(self._cursor)
 
-  def _sync_to_cropping_box(self, x, y, w, h, dx, dy):
-    ww = w + dx
-    hh = h + dy
-    if (ww > 50 or ww > w) and (hh > 50 or hh > h):
-      self._rect.set_property('width', ww)
-      self._rect.set_property('height', hh)
-      return True
 
-    return False
+  def __on_mouse_leave(self, item, target, event):
+    item.get_canvas().get_window().set_cursor(None)
 
 
+# The cropping rectangle and its resize handles. The children are laid out
+# relative to the group, and the group transform places the box: moving the
+# box is a single transform change, and resizing sets the rectangle size and
+# the handle transforms once per update, with no property fan-out.
 class CroppingBox(GooCanvas.CanvasGroup):
-  def __init__(self, parent, x, y, w, h, stroke=0x66CCFF55, fill=0xFFEECC66):
+  RESIZERS = (
+    ((0.5, 0.0), Gdk.CursorType.TOP_SIDE),
+    ((1.0, 0.5), Gdk.CursorType.RIGHT_SIDE),
+    ((0.5, 1.0), Gdk.CursorType.BOTTOM_SIDE),
+    ((0.0, 0.5), Gdk.CursorType.LEFT_SIDE),
+    ((0.0, 0.0), Gdk.CursorType.TOP_LEFT_CORNER),
+    ((1.0, 0.0), Gdk.CursorType.TOP_RIGHT_CORNER),
+    ((1.0, 1.0), Gdk.CursorType.BOTTOM_RIGHT_CORNER),
+    ((0.0, 1.0), Gdk.CursorType.BOTTOM_LEFT_CORNER),
+  )
+
+  def __init__(self, slot, x, y, w, h, stroke=0x66CCFF55, fill=0xFFEECC66):
+    self.slot = slot
     self.__dragging = False
+    self.__motion = MotionCoalescer(self.__drag_to)
     self.__drag_x = None
     self.__drag_y = None
-    GooCanvas.CanvasGroup.__init__(self, parent=parent)
+    self.__drag_geometry = None
+    self.__geometry = None
+    GooCanvas.CanvasGroup.__init__(self, parent=slot)
     self.__rect = GooCanvas.CanvasRect(
         parent=self,
-        x=x, y=y, width=w, height=h,
+        x=0, y=0, width=w, height=h,
         stroke_color_rgba=stroke,
         fill_color_rgba=fill,
         line_width=2.0)
     self.connect("motion_notify_event", self.__on_motion_notify)
     self.connect("button_press_event", self.__on_button_press)
     self.connect("button_release_event", self.__on_button_release)
-    self.__resizers = [
-      UResizer(self, self.__rect, x + w/2.0, y),
-      RResizer(self, self.__rect, x + w, y + h/2.0),
-      BResizer(self, self.__rect, x + w/2.0, y + h),
-      LResizer(self, self.__rect, x, y + h/2.0),
-      ULResizer(self, self.__rect, x, y),
-      URResizer(self, self.__rect, x + w, y),
-      BRResizer(self, self.__rect, x + w, y + h),
-      BLResizer(self, self.__rect, x, y + h),
-    ]
-    self.__resizers[0].set_listeners(
-        dy_listeners=[self.__resizers[i] for i in (4, 5)],
-        dy2_listeners=[self.__resizers[i] for i in (1, 3)])
-    self.__resizers[1].set_listeners(
-        dx_listeners=[self.__resizers[i] for i in (5, 6)],
-        dx2_listeners=[self.__resizers[i] for i in (0, 2)])
-    self.__resizers[2].set_listeners(
-        dy_listeners=[self.__resizers[i] for i in (6, 7)],
-        dy2_listeners=[self.__resizers[i] for i in (1, 3)])
-    self.__resizers[3].set_listeners(
-        dx_listeners=[self.__resizers[i] for i in (4, 7)],
-        dx2_listeners=[self.__resizers[i] for i in (0, 2)])
-    self.__resizers[4].set_listeners(
-        dx_listeners=[self.__resizers[7]],
-        dx2_listeners=[self.__resizers[2]],
-        dy_listeners=[self.__resizers[5]],
-        dy2_listeners=[self.__resizers[1]],
-        dx2dy_listeners=[self.__resizers[0]],
-        dxdy2_listeners=[self.__resizers[3]])
-    self.__resizers[5].set_listeners(
-        dx_listeners=[self.__resizers[6]],
-        dx2_listeners=[self.__resizers[2]],
-        dy_listeners=[self.__resizers[4]],
-        dy2_listeners=[self.__resizers[3]],
-        dx2dy_listeners=[self.__resizers[0]],
-        dxdy2_listeners=[self.__resizers[1]])
-    self.__resizers[6].set_listeners(
-        dx_listeners=[self.__resizers[5]],
-        dx2_listeners=[self.__resizers[0]],
-        dy_listeners=[self.__resizers[7]],
-        dy2_listeners=[self.__resizers[3]],
-        dx2dy_listeners=[self.__resizers[2]],
-        dxdy2_listeners=[self.__resizers[1]])
-    self.__resizers[7].set_listeners(
-        dx_listeners=[self.__resizers[4]],
-        dx2_listeners=[self.__resizers[0]],
-        dy_listeners=[self.__resizers[6]],
-        dy2_listeners=[self.__resizers[1]],
-        dx2dy_listeners=[self.__resizers[2]],
-        dxdy2_listeners=[self.__resizers[3]])
+    self.__resizers = [Resizer(self, anchor, cursor_type)
+                       for anchor, cursor_type in self.RESIZERS]
+    self.set_geometry(x, y, w, h)
 
 
-  def __on_motion_notify(self, item, target, event):
-    if self.__dragging and (event.state & Gdk.ModifierType.BUTTON1_MASK):
-      # don't allow it move out of page
-      bound = item.get_canvas().page_region
-      if (event.x < bound.x or
-          event.y < bound.y or
-          event.x > bound.x + bound.width or
-          event.y > bound.y + bound.height):
-        return True
+  @property
+  def geometry(self):
+    return self.__geometry
+
 
-      dx = event.x - self.__drag_x
-      dy = event.y - self.__drag_y
-      self.__rect.props.x = self.__rect.props.x + dx
-      self.__rect.props.y = self.__rect.props.y + dy
+  def set_geometry(self, x, y, w, h):
+    old = self.__geometry
+    if old is None or (w, h) != old[2:]:
+      self.__rect.set_properties(width=w, height=h)
       for resizer in self.__resizers:
-        resizer.props.x = resizer.props.x + dx
-        resizer.props.y = resizer.props.y + dy
-      self.__drag_x = event.x
-      self.__drag_y = event.y
-      page_info = item.get_canvas().page_info
-      crop_setting = page_info.crop_setting
-      crop_setting['x'] = self.__rect.props.x
-      crop_setting['y'] = self.__rect.props.y
-      crop_setting['w'] = self.__rect.props.width
-      crop_setting['h'] = self.__rect.props.height
+        resizer.place(w, h)
+    if old is None or (x, y) != old[:2]:
+      self.set_simple_transform(x, y, 1.0, 0.0)
+    self.__geometry = (x, y, w, h)
 
+
+  def __on_motion_notify(self, item, target, event):
+    if self.__dragging and (event.state & Gdk.ModifierType.BUTTON1_MASK):
+      # x_root and y_root are in canvas space, x and y in item space.
+      self.__motion.push(item.get_canvas(), event.x_root, event.y_root)
     return True
 
 
+  def __drag_to(self, event_x, event_y):
+    if self.__dragging:
+      # don't allow it move out of page
+      bound = self.slot.region
+      if (event_x < bound.x or
+          event_y < bound.y or
+          event_x > bound.x + bound.width or
+          event_y > bound.y + bound.height):
+        return
+
+      x, y, w, h = self.__drag_geometry
+      self.set_geometry(x + event_x - self.__drag_x,
+                        y + event_y - self.__drag_y, w, h)
+
+
   def __on_button_press(self, item, target, event):
     if event.button == 1:
-      self.__drag_x = event.x
-      self.__drag_y = event.y
+      self.__drag_x = event.x_root
+      self.__drag_y = event.y_root
+      self.__drag_geometry = self.__geometry
 
       fleur = Gdk.Cursor(Gdk.CursorType.FLEUR)
       item.get_canvas().pointer_grab(
@@ -556,34 +1782,76 @@ class CroppingBox(GooCanvas.CanvasGroup):
   def __on_button_release(self, item, target, event):
     if event.button == 1:
       item.get_canvas().pointer_ungrab(item, event.time)
+      # The crop setting is only written once the drag is over.
+      self.__motion.flush()
       self.__dragging = False
+      # A click without a drag leaves an inherited crop alone.
+      if self.__geometry != self.__drag_geometry:
+        store_crop(self.slot, *self.__geometry)
     return True
 
 
   def update(self):
-    page_info = self.get_canvas().page_info
-    crop_setting = page_info.crop_setting
-    if not crop_setting.empty():
-      x, y, w, h = (crop_setting['x'],
-                    crop_setting['y'],
-                    crop_setting['w'],
-                    crop_setting['h'])
-      self.__rect.set_property('x', x)
-      self.__rect.set_property('y', y)
-      self.__rect.set_property('width', w)
-      self.__rect.set_property('height', h)
-      for resizer in self.__resizers:
-        resizer.sync_from_cropping_box(x, y, x+w, y+h)
+    page_info = self.slot.page_info
+    crop = page_info.crop if page_info else None
+    if crop:
+      scale = self.get_canvas().get_scale()
+      self.set_geometry(*[value * scale for value in crop])
+      self.props.visibility = GooCanvas.CanvasItemVisibility.VISIBLE
+    else:
+      self.props.visibility = GooCanvas.CanvasItemVisibility.INVISIBLE
 
 
-class PdfView(GooCanvas.CanvasImage):
+# One page on the canvas: its PdfView and its cropping box, placed by the
+# group transform so that they work in page coordinates. The slot holds the
+# page shown and its region in canvas coordinates. on_crop_changed is called
+# after the crop of the page is edited, and on_auto_crop(page_info) when the
+# page is double-clicked.
+class PageSlot(GooCanvas.CanvasGroup):
+  def __init__(self, parent, on_crop_changed=None, on_auto_crop=None):
+    GooCanvas.CanvasGroup.__init__(self, parent=parent)
+    self.page_info = None
+    self.region = Gdk.Rectangle()
+    self.on_crop_changed = on_crop_changed
+    self.on_auto_crop = on_auto_crop
+    # The ghost surfaces of the odd and even pages, painted over the page.
+    self.ghosts = None
+    self.view = PdfView()
+    self.add_child(self.view, -1)
+
+
+  def place(self, x, y, w, h):
+    if (x, y) != (self.region.x, self.region.y):
+      self.set_simple_transform(x, y, 1.0, 0.0)
+    self.region.x, self.region.y = x, y
+    self.region.width, self.region.height = w, h
+
+
+  def show(self, visible):
+    if visible:
+      self.props.visibility = GooCanvas.CanvasItemVisibility.VISIBLE
+    else:
+      self.props.visibility = GooCanvas.CanvasItemVisibility.INVISIBLE
+
+
+# Paints the rendered cairo surfaces straight onto the canvas, so they are
+# never converted to pixbufs. A surface smaller than the page, like a quick
+# preview, is stretched over it, and the tiles of large pages are painted on
+# top at their position.
+class PdfView(GooCanvas.CanvasItemSimple, GooCanvas.CanvasItem):
   def __init__(self,):
     self.__cropping_box = None
     self.__dragging = False
     self.__start_x = None
     self.__start_y = None
     self.__rubberband = None
-    GooCanvas.CanvasImage.__init__(self, pixbuf=None, x=0, y=0)
+    self.__surface = None
+    self.__width = 0
+    self.__height = 0
+    self.__tiles = {}
+    GooCanvas.CanvasItemSimple.__init__(self)
+    # The whole page area receives the button events, painted or not.
+    self.props.pointer_events = GooCanvas.CanvasPointerEvents.FILL
     self.connect("motion_notify_event", self.__on_motion_notify)
     self.connect("button_press_event", self.__on_button_press)
     self.connect("button_release_event", self.__on_button_release)
@@ -591,12 +1859,12 @@ class PdfView(GooCanvas.CanvasImage):
 
   def __on_motion_notify(self, item, target, event):
     if self.__dragging:
-      # don't allow it move out of page
-      bound = item.get_canvas().page_region
-      if (event.x < bound.x or
-          event.y < bound.y or
-          event.x > bound.x + bound.width or
-          event.y > bound.y + bound.height):
+      # don't allow it move out of page, event.x and y are relative to it
+      bound = self.get_parent().region
+      if (event.x < 0 or
+          event.y < 0 or
+          event.x > bound.width or
+          event.y > bound.height):
         return True
 
       if event.x > self.__start_x:
@@ -615,7 +1883,11 @@ class PdfView(GooCanvas.CanvasImage):
 
 
   def __on_button_press(self, item, target, event):
-    if event.button == 1 and not self.__cropping_box:
+    slot = self.get_parent()
+    if (event.type == Gdk.EventType._2BUTTON_PRESS and event.button == 1 and
+        slot.page_info and slot.on_auto_crop):
+      slot.on_auto_crop(slot.page_info)
+    elif event.button == 1 and slot.page_info and not slot.page_info.crop:
       canvas = item.get_canvas()
       self.__dragging = True
       self.__start_x = event.x
@@ -625,7 +1897,7 @@ class PdfView(GooCanvas.CanvasImage):
           stroke_color_rgba=0x66CCFF55,
           fill_color_rgba=0xFFEECC66,
           line_width=2.0)
-      canvas.get_root_item().add_child(self.__rubberband, next_index())
+      slot.add_child(self.__rubberband, -1)
       fleur = Gdk.Cursor(Gdk.CursorType.FLEUR)
       canvas.pointer_grab(
           item,
@@ -647,30 +1919,115 @@ class PdfView(GooCanvas.CanvasImage):
                     self.__rubberband.props.height)
       self.__rubberband.remove()
 
+      # A plain click, maybe the first half of a double-click, crops nothing.
+      if w < 10 and h < 10:
+        return True
       if w < 10:
         w = 10
       if h < 10:
         h = 10
 
-      page_info = canvas.page_info
-      crop_setting = page_info.crop_setting
-      crop_setting['x'] = x
-      crop_setting['y'] = y
-      crop_setting['w'] = w
-      crop_setting['h'] = h
-      self.__cropping_box = CroppingBox(canvas.get_root_item(), x, y, w, h)
+      store_crop(self.get_parent(), x, y, w, h)
+      self.update_cropping_box()
 
     return True
 
 
-  def redraw(self, page_info=None, pixbuf=None):
-    if pixbuf:
-      self.get_canvas().page_info = page_info
-      self.props.pixbuf = pixbuf
-      if self.__cropping_box:
-        self.__cropping_box.update()
+  def update_cropping_box(self):
+    # The box is made for the first page with a crop shown here, and then
+    # follows the crop of whatever page is shown.
+    slot = self.get_parent()
+    if not self.__cropping_box:
+      if not (slot.page_info and slot.page_info.crop):
+        return
+      self.__cropping_box = CroppingBox(slot, 0, 0, 0, 0)
+    self.__cropping_box.update()
+
+
+  def do_simple_create_path(self, cr):
+    cr.rectangle(0, 0, self.__width, self.__height)
+
+
+  def do_simple_paint(self, cr, bounds):
+    surface = self.__surface
+    if surface is not None:
+      cr.save()
+      cr.rectangle(0, 0, self.__width, self.__height)
+      cr.clip()
+      cr.scale(float(self.__width) / surface.get_width(),
+               float(self.__height) / surface.get_height())
+      paint_surface(cr, surface)
+      cr.restore()
+    for x, y, tile in self.__tiles.values():
+      paint_surface(cr, tile, x, y)
+    slot = self.get_parent()
+    if slot.ghosts and slot.page_info:
+      ghost = slot.ghosts[slot.page_info.pagenum % 2]
+      if ghost:
+        paint_ghost(cr, ghost, self.get_canvas().get_scale() / GHOST_SCALE)
+
+
+  def __resize(self, w, h):
+    if (w, h) != (self.__width, self.__height):
+      self.__width, self.__height = w, h
+      self.changed(True)
     else:
-      self.props.pixbuf = None
+      self.changed(False)
+
+
+  def redraw(self, page_info=None, surface=None, width=None, height=None):
+    self.__tiles.clear()
+    self.__surface = surface
+    if surface:
+      self.get_parent().page_info = page_info
+      self.__resize(width or surface.get_width(),
+                    height or surface.get_height())
+    else:
+      self.get_parent().page_info = None
+      self.__resize(0, 0)
+    self.update_cropping_box()
+
+
+  def rescale(self, w, h):
+    # Stretch whatever is shown to the new page size until the page is
+    # rendered at the new scale. Tiles are positioned for the old scale.
+    self.__tiles.clear()
+    self.__resize(w, h)
+    self.update_cropping_box()
+
+
+  def redraw_tiled(self, page_info, w, h):
+    # The page is painted by tiles added later on, over the preview of the
+    # page if there is one.
+    self.__tiles.clear()
+    slot = self.get_parent()
+    if slot.page_info is not page_info:
+      slot.page_info = page_info
+      self.__surface = None
+    self.__resize(w, h)
+    self.update_cropping_box()
+
+
+  def has_tile(self, key):
+    return key in self.__tiles
+
+
+  def add_tile(self, key, x, y, surface):
+    self.__tiles[key] = (x, y, surface)
+    self.changed(False)
+
+
+  def prune_tiles(self, x0, y0, x1, y1):
+    # Drop the tiles which no longer intersect the given canvas region.
+    for key, (x, y, tile) in list(self.__tiles.items()):
+      if (x + tile.get_width() < x0 or x > x1 or
+          y + tile.get_height() < y0 or y > y1):
+        del self.__tiles[key]
+
+
+  def clear_tiles(self):
+    self.__tiles.clear()
+    self.changed(False)
 
 
 class MainWindow(Gtk.Window):
@@ -700,19 +2057,64 @@ class MainWindow(Gtk.Window):
                                                          Gtk.IconSize.SMALL_TOOLBAR)),
          self.__on_zoom_out_btn_clicked,
          'Zoom Out'),
+        (Gtk.ToolButton.new(Gtk.Image.new_from_icon_name("zoom-fit-best",
+                                                         Gtk.IconSize.SMALL_TOOLBAR)),
+         self.__on_auto_crop_btn_clicked,
+         'Auto Crop'),
+        (Gtk.ToolButton.new(Gtk.Image.new_from_icon_name("edit-select-all",
+                                                         Gtk.IconSize.SMALL_TOOLBAR)),
+         self.__on_crop_all_btn_clicked,
+         'Auto Crop All Pages'),
+        (Gtk.ToolButton.new(Gtk.Image.new_from_icon_name("format-text-bold",
+                                                         Gtk.IconSize.SMALL_TOOLBAR)),
+         self.__on_layout_crop_all_btn_clicked,
+         'Auto Crop All Pages from Text Layout'),
+        (Gtk.ToolButton.new(Gtk.Image.new_from_icon_name("document-properties",
+                                                         Gtk.IconSize.SMALL_TOOLBAR)),
+         self.__on_group_pages_btn_clicked,
+         'Group Pages by Layout'),
     )
     for button, callback, tooltip in buttons:
       button.set_tooltip_text(tooltip)
       button.connect_after('clicked', callback)
       toolbar.insert(button, -1)
+    # Auto-crop looks at the rendered pages through numpy.
+    for button, _, _ in buttons[-4:]:
+      button.set_sensitive(numpy is not None)
+
+    self.__gray_button = Gtk.ToggleToolButton.new()
+    self.__gray_button.set_icon_widget(
+        Gtk.Image.new_from_icon_name("applications-graphics",
+                                     Gtk.IconSize.SMALL_TOOLBAR))
+    self.__gray_button.set_tooltip_text('Grayscale')
+    self.__gray_handler = self.__gray_button.connect('toggled',
+                                                     self.__on_gray_toggled)
+    toolbar.insert(self.__gray_button, -1)
+
+    self.__continuous_button = Gtk.ToggleToolButton.new()
+    self.__continuous_button.set_icon_widget(
+        Gtk.Image.new_from_icon_name("format-justify-fill",
+                                     Gtk.IconSize.SMALL_TOOLBAR))
+    self.__continuous_button.set_tooltip_text('Continuous')
+    self.__continuous_button.connect('toggled', self.__on_continuous_toggled)
+    toolbar.insert(self.__continuous_button, -1)
+
+    self.__ghost_button = Gtk.ToggleToolButton.new()
+    self.__ghost_button.set_icon_widget(
+        Gtk.Image.new_from_icon_name("edit-copy",
+                                     Gtk.IconSize.SMALL_TOOLBAR))
+    self.__ghost_button.set_tooltip_text('Ghost of All Pages')
+    self.__ghost_button.set_sensitive(numpy is not None)
+    self.__ghost_button.connect('toggled', self.__on_ghost_toggled)
+    toolbar.insert(self.__ghost_button, -1)
     vbox.pack_start(toolbar, expand=False, fill=False, padding=0)
 
     # main component
     paned = Gtk.HPaned()
-    paned.set_position(100)
+    paned.set_position(THUMBNAIL_SIZE + 70)
     vbox.pack_start(paned, expand=True, fill=True, padding=0)
 
-    self.__pages_model = Gtk.ListStore(str, object)
+    self.__pages_model = PagesModel()
     self.__pages_view = Gtk.TreeView.new_with_model(self.__pages_model)
     self.__pages_view.set_enable_search(False)
     self.__pages_view.get_selection().set_mode(Gtk.SelectionMode.SINGLE)
@@ -722,20 +2124,31 @@ class MainWindow(Gtk.Window):
     # columns
     column = Gtk.TreeViewColumn()
     column.set_title('Pages')
-    column.set_sizing(Gtk.TreeViewColumnSizing.AUTOSIZE)
+    # Rows all have the same height, so the view never has to measure the
+    # rows of long documents.
+    column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+    column.set_fixed_width(THUMBNAIL_SIZE + 60)
+    renderer = Gtk.CellRendererPixbuf()
+    renderer.set_fixed_size(THUMBNAIL_SIZE + 8, THUMBNAIL_SIZE + 8)
+    column.pack_start(renderer, False)
+    column.set_cell_data_func(renderer, self.__render_thumbnail)
     renderer = Gtk.CellRendererText()
     column.pack_start(renderer, False)
     column.add_attribute(renderer, 'text', 0)
     column.set_cell_data_func(renderer, self.__render_page_number)
     self.__pages_view.append_column(column)
+    self.__pages_view.set_fixed_height_mode(True)
 
     sw = Gtk.ScrolledWindow()
     sw.add(self.__pages_view)
+    sw.get_vadjustment().connect('value-changed', self.__on_pages_scrolled)
+    sw.get_vadjustment().connect('changed', self.__on_pages_scrolled)
     paned.add1(sw)
 
-    self.__zoom_level = DEFAULT_ZOOM_LEVEL
+    self.__zoom_refine_id = None
     self.__canvas = GooCanvas.Canvas()
     self.__canvas.set_scale(ZOOM_LEVELS[DEFAULT_ZOOM_LEVEL])
+    self.__canvas.connect('scroll-event', self.__on_canvas_scroll)
     self.__canvas.override_background_color(Gtk.StateType.NORMAL, Gdk.RGBA(240/255,240/255,240/255))
     self.__dragging = False
 
@@ -746,8 +2159,29 @@ class MainWindow(Gtk.Window):
 
     sw = Gtk.ScrolledWindow()
     sw.add(self.__canvas)
+    sw.get_hadjustment().connect('value-changed', self.__on_viewport_changed)
+    sw.get_vadjustment().connect('value-changed', self.__on_viewport_changed)
+    self.__canvas.connect('size-allocate', self.__on_viewport_changed)
+    self.__canvas_window = sw
     frame.add(sw)
 
+    self.__statusbar = Gtk.Statusbar()
+    self.__cache_status_id = self.__statusbar.get_context_id('render-cache')
+    self.__progress = Gtk.ProgressBar()
+    self.__progress.set_show_text(True)
+    self.__progress.set_no_show_all(True)
+    self.__statusbar.pack_end(self.__progress, False, False, 0)
+    self.__task_cancel = Gtk.Button.new_with_label('Cancel')
+    self.__task_cancel.set_no_show_all(True)
+    self.__task_cancel.connect('clicked', self.__on_task_cancel_clicked)
+    self.__statusbar.pack_end(self.__task_cancel, False, False, 0)
+    self.__task_progress = Gtk.ProgressBar()
+    self.__task_progress.set_show_text(True)
+    self.__task_progress.set_no_show_all(True)
+    self.__statusbar.pack_end(self.__task_progress, False, False, 0)
+    self.__load_pulse_id = None
+    vbox.pack_start(self.__statusbar, expand=False, fill=False, padding=0)
+
     accels = Gtk.AccelGroup()
     accels.connect(ord('o'),
                    Gdk.ModifierType.CONTROL_MASK,
@@ -776,16 +2210,55 @@ class MainWindow(Gtk.Window):
     self.add_accel_group(accels)
 
     self.__current_page = None
+    self.__tiled = False
+    self.__pending_tiles = {}
     self.__pdf_filename = None
     self.__pdf_document = None
     self.__n_pages = None
     self.__pdf_view = None
-    self.__default_crop = CropSetting()
-    self.__odd_crop = CropSetting(self.__default_crop)
-    self.__even_crop = CropSetting(self.__default_crop)
+    self.__page_slot = None
+    self.__continuous = False
+    # Continuous view: the top of every page and the end of the last one, the
+    # slots of the pages near the viewport by page number, the slots not in
+    # use, and the pending renders by page number.
+    self.__page_tops = array('d')
+    self.__slots = {}
+    self.__free_slots = []
+    self.__slot_jobs = {}
+    self.__render_worker = RenderWorker()
+    self.__render_cache = RenderCache(RENDER_CACHE_MB * 1024 * 1024)
+    self.__thumbnails = RenderCache(THUMBNAIL_CACHE_MB * 1024 * 1024)
+    self.__disk_cache = DiskCache(cache_directory(),
+                                  DISK_CACHE_MB * 1024 * 1024)
+    self.__file_identity = None
+    self.__gray = False
+    self.__gray_chosen = False
+    self.__pending_thumbnails = {}
+    self.__thumbnails_queued = False
+    self.__crop_table = CropTable(0)
+    self.__geometry = PageGeometry(0)
+    self.__geometry_scan = None
+    self.__loader = None
+    self.__mapped_file = None
+    self.__exporter = None
+    # Set when the window is closed during an export, which is cancelled and
+    # quits once its partial file is removed.
+    self.__quit_after_export = False
+    self.__page_task = None
+    # The ghost images of the odd and of the even pages, see GhostImage, and
+    # the surfaces shown of them.
+    self.__ghost_images = None
+    self.__ghosts = None
+    self.__warm_reader = None
+    self.__reader_warmup = None
 
 
   def __on_delete_window(self, window, event):
+    if self.__exporter:
+      self.__exporter.cancelled = True
+      self.__quit_after_export = True
+      self.hide()
+      return True
     Gtk.main_quit()
 
 
@@ -813,6 +2286,171 @@ class MainWindow(Gtk.Window):
     return self.__zoom_out_page()
 
 
+  def __on_auto_crop_btn_clicked(self, button):
+    tree_store, tree_iter = self.__pages_view.get_selection().get_selected()
+    if tree_iter:
+      self.__auto_crop(tree_store[tree_iter][1])
+
+
+  def __auto_crop(self, page_info):
+    if numpy is None or not self.__pdf_document:
+      return
+    document = self.__pdf_document
+    self.__render_worker.submit(RenderJob(
+        'autocrop',
+        lambda: auto_crop(document, page_info.pagenum),
+        lambda crop: self.__on_auto_cropped(document, page_info, crop),
+        PRIORITY_PAGE))
+
+
+  def __on_auto_cropped(self, document, page_info, crop):
+    if crop and document is self.__pdf_document:
+      page_info.set_crop(*crop)
+      self.__on_crop_changed()
+
+
+  def __start_page_task(self, func, text, on_result, on_done):
+    # One background task at a time: the crops must not change under an
+    # export.
+    if (numpy is None or not self.__pdf_document or self.__exporter or
+        self.__page_task):
+      return False
+    document = self.__pdf_document
+    self.__task_progress.set_fraction(0.0)
+    self.__task_progress.set_text(text)
+    self.__task_progress.show()
+    self.__task_cancel.show()
+
+    def done(completed):
+      self.__page_task = None
+      self.__task_progress.hide()
+      self.__task_cancel.hide()
+      on_done(completed and document is self.__pdf_document)
+
+    self.__page_task = PageTask(
+        os.path.abspath(self.__pdf_filename), range(self.__n_pages), func,
+        text, on_result, self.__on_task_progress, done)
+    return True
+
+
+  def __on_crop_all_btn_clicked(self, button, func=auto_crop_page):
+    boxes = [None] * (self.__n_pages or 0)
+
+    def on_result(pagenum, box):
+      boxes[pagenum] = box
+
+    def on_done(completed):
+      if completed:
+        self.__crop_table.set_groups(*crop_groups(boxes))
+        self.__on_crop_changed()
+
+    self.__start_page_task(func, 'Cropping pages', on_result, on_done)
+
+
+  def __on_layout_crop_all_btn_clicked(self, button):
+    # Much quicker on born-digital documents, but blind to figures drawn
+    # only with paths.
+    self.__on_crop_all_btn_clicked(button, layout_crop_page)
+
+
+  def __on_group_pages_btn_clicked(self, button):
+    # Pages are grouped by their crop suggestion and size, and each group
+    # shares one crop setting.
+    boxes = [None] * (self.__n_pages or 0)
+
+    def on_result(pagenum, box):
+      boxes[pagenum] = box
+
+    def on_done(completed):
+      if completed:
+        sizes = [self.__geometry.size(pagenum) for pagenum in range(len(boxes))]
+        self.__crop_table.set_clusters(cluster_pages(boxes, sizes))
+        self.__on_crop_changed()
+        self.__statusbar.pop(self.__cache_status_id)
+        self.__statusbar.push(self.__cache_status_id,
+                              '%d page groups' % self.__crop_table.groups())
+
+    self.__start_page_task(auto_crop_page, 'Grouping pages', on_result,
+                           on_done)
+
+
+  def __on_ghost_toggled(self, button):
+    if button.get_active():
+      if not self.__ghost_images and not self.__start_ghost():
+        # Busy with another task, or nothing to superimpose.
+        button.set_active(False)
+        return
+    self.__show_ghost()
+
+
+  def __start_ghost(self):
+    # Odd and even pages are superimposed apart, as they are cropped apart.
+    ghosts = [GhostImage(*self.__geometry.max_size()) for _ in range(2)]
+
+    def on_result(pagenum, coverage):
+      ghosts[pagenum % 2].add(coverage)
+
+    def on_done(completed):
+      if not completed and ghosts is self.__ghost_images:
+        self.__ghost_images = None
+        self.__ghost_button.set_active(False)
+      self.__show_ghost()
+
+    if not self.__start_page_task(ghost_page, 'Superimposing pages',
+                                  on_result, on_done):
+      return False
+    self.__ghost_images = ghosts
+    return True
+
+
+  def __show_ghost(self):
+    # Called as the pages are superimposed, to show what there is so far.
+    ghosts = None
+    if self.__ghost_button.get_active() and self.__ghost_images:
+      ghosts = [ghost.surfaces() for ghost in self.__ghost_images]
+    self.__ghosts = ghosts
+    slots = list(self.__slots.values())
+    if self.__page_slot:
+      slots.append(self.__page_slot)
+    for slot in slots:
+      slot.ghosts = ghosts
+      slot.view.changed(False)
+
+
+  def __on_gray_toggled(self, button):
+    self.__gray = button.get_active()
+    self.__gray_chosen = True
+    if self.__pdf_document:
+      self.__on_page_selected()
+
+
+  def __set_gray(self, gray):
+    with self.__gray_button.handler_block(self.__gray_handler):
+      self.__gray_button.set_active(gray)
+    self.__gray = gray
+
+
+  def __detect_gray(self):
+    # Scanned documents are mostly black and white or grayscale; look at the
+    # first pages and switch to grayscale rendering if they are.
+    document = self.__pdf_document
+    n_pages = min(self.__n_pages, GRAY_DETECT_PAGES)
+
+    def detect():
+      return all(
+          is_grayscale(render_thumbnail(document, pagenum, THUMBNAIL_SIZE))
+          for pagenum in range(n_pages))
+
+    self.__render_worker.submit(RenderJob(
+        'detect', detect, self.__on_gray_detected, PRIORITY_THUMBNAIL))
+
+
+  def __on_gray_detected(self, gray):
+    if gray and not self.__gray_chosen:
+      self.__set_gray(True)
+      self.__on_page_selected()
+
+
   def __on_zoom_in_pressed(self, accel_group, acceleratable, keyval, modifier):
     return self.__zoom_in_page()
 
@@ -828,20 +2466,137 @@ class MainWindow(Gtk.Window):
       cell.set_property('weight', Pango.Weight.NORMAL)
 
 
+  def __render_thumbnail(self, column, cell, model, tree_iter, data):
+    page_info = model[tree_iter][1]
+    cell.set_property('surface', self.__thumbnails.peek(
+        (self.__file_identity, page_info.pagenum)))
+
+
+  def __on_pages_scrolled(self, adjustment):
+    # Coalesce the scroll events, thumbnails are requested once per idle.
+    if not self.__thumbnails_queued:
+      self.__thumbnails_queued = True
+      GLib.idle_add(self.__request_thumbnails)
+
+
+  def __request_thumbnails(self):
+    self.__thumbnails_queued = False
+    visible = self.__pages_view.get_visible_range()
+    wanted = set()
+    if visible and self.__pdf_document:
+      document = self.__pdf_document
+      thumbnails = self.__thumbnails
+      disk_cache = self.__disk_cache
+      store = self.__store_on_disk
+      identity = self.__file_identity
+      first, last = visible[0].get_indices()[0], visible[1].get_indices()[0]
+      for row in range(first, last + 1):
+        pagenum = self.__pages_model.page_info(row).pagenum
+        wanted.add(pagenum)
+        if ((identity, pagenum) in thumbnails or
+            pagenum in self.__pending_thumbnails):
+          continue
+
+        def render(pagenum=pagenum):
+          disk_key = (identity, 'thumbnail', pagenum, THUMBNAIL_SIZE)
+          surface = disk_cache.get(disk_key)
+          if surface is None:
+            surface = render_thumbnail(document, pagenum, THUMBNAIL_SIZE)
+            store(disk_key, surface)
+          thumbnails.put((identity, pagenum), surface, surface_nbytes(surface))
+          return surface
+
+        self.__pending_thumbnails[pagenum] = self.__render_worker.submit(
+            RenderJob('thumbnail',
+                      render,
+                      lambda surface, row=row: self.__on_thumbnail_rendered(row),
+                      PRIORITY_THUMBNAIL))
+
+    # Rows scrolled out of view before their thumbnail was rendered.
+    for pagenum in list(self.__pending_thumbnails):
+      if pagenum not in wanted:
+        self.__pending_thumbnails.pop(pagenum).cancelled = True
+    return False
+
+
+  def __on_thumbnail_rendered(self, row):
+    path = Gtk.TreePath(row)
+    self.__pending_thumbnails.pop(self.__pages_model.page_info(row).pagenum,
+                                  None)
+    self.__pages_model.row_changed(path, self.__pages_model.get_iter(path))
+
+
   def __zoom_in_page(self):
-    if self.__pdf_document and self.__zoom_level < len(ZOOM_LEVELS) - 1:
-      self.__zoom_level += 1
-      self.__canvas.set_scale(ZOOM_LEVELS[self.__zoom_level])
-      self.__on_page_selected()
-      return True
+    if self.__pdf_document:
+      scale = self.__canvas.get_scale()
+      for zoom in ZOOM_LEVELS:
+        if zoom > scale + 1e-6:
+          self.__set_zoom(zoom)
+          return True
 
 
   def __zoom_out_page(self):
-    if self.__pdf_document and self.__zoom_level > 0:
-      self.__zoom_level -= 1
-      self.__canvas.set_scale(ZOOM_LEVELS[self.__zoom_level])
-      self.__on_page_selected()
-      return True
+    if self.__pdf_document:
+      scale = self.__canvas.get_scale()
+      for zoom in reversed(ZOOM_LEVELS):
+        if zoom < scale - 1e-6:
+          self.__set_zoom(zoom)
+          return True
+
+
+  def __on_canvas_scroll(self, canvas, event):
+    if not (event.state & Gdk.ModifierType.CONTROL_MASK):
+      return False
+    if self.__pdf_document:
+      if event.direction == Gdk.ScrollDirection.UP:
+        steps = 1
+      elif event.direction == Gdk.ScrollDirection.DOWN:
+        steps = -1
+      elif event.direction == Gdk.ScrollDirection.SMOOTH:
+        steps = -event.get_scroll_deltas()[2]
+      else:
+        return True
+      zoom = self.__canvas.get_scale() * ZOOM_STEP ** steps
+      self.__set_zoom(min(max(zoom, ZOOM_LEVELS[0]), ZOOM_LEVELS[-1]))
+    return True
+
+
+  def __set_zoom(self, zoom):
+    # Rounded, so that continuous zoom does not fill the render cache with
+    # scales that differ by a hair.
+    zoom = round(zoom, 3)
+    scale = self.__canvas.get_scale()
+    if zoom == scale:
+      return
+    self.__render_worker.cancel('page')
+    self.__render_worker.cancel('prefetch')
+    self.__render_worker.cancel('tile')
+    self.__pending_tiles.clear()
+    self.__canvas.set_scale(zoom)
+
+    # Show the current bitmap rescaled right away, the page is rendered again
+    # once the zoom settles.
+    if self.__continuous:
+      self.__render_worker.cancel('slot')
+      self.__slot_jobs.clear()
+      self.__layout_pages()
+      self.__update_slots()
+    elif self.__current_page:
+      page_width, page_height = self.__current_page.size
+      w, h = int(int(page_width) * zoom), int(int(page_height) * zoom)
+      self.__set_page_region(w, h)
+      self.__pdf_view.rescale(w, h)
+
+    if self.__zoom_refine_id is not None:
+      GLib.source_remove(self.__zoom_refine_id)
+    self.__zoom_refine_id = GLib.timeout_add(ZOOM_REFINE_DELAY_MS,
+                                             self.__on_zoom_settled)
+
+
+  def __on_zoom_settled(self):
+    self.__zoom_refine_id = None
+    self.__on_page_selected()
+    return False
 
 
   def __open_file(self):
@@ -873,14 +2628,13 @@ class MainWindow(Gtk.Window):
 
     if pdf_file_name:
       self.__load_pdf_file(pdf_file_name)
-      self.__pages_view.get_selection().select_iter(
-          self.__pages_model.get_iter_first())
 
     return True
 
 
   def __save_file(self):
-    if not self.__pdf_document:
+    # One background task at a time; pages can still be browsed meanwhile.
+    if not self.__pdf_document or self.__exporter or self.__page_task:
       return True
 
     dialog = Gtk.FileChooserDialog(title='Export pdf file',
@@ -909,6 +2663,8 @@ class MainWindow(Gtk.Window):
     finally:
       dialog.destroy()
 
+    if not new_pdf_file_name:
+      return True
     if os.path.exists(new_pdf_file_name):
       msg_dialog = Gtk.MessageDialog(self,0,Gtk.MessageType.ERROR,Gtk.ButtonsType.CANCEL)
       msg_dialog.set_markup('File exists!')
@@ -916,65 +2672,82 @@ class MainWindow(Gtk.Window):
       msg_dialog.destroy()
       return True
 
-    with open(self.__pdf_filename, 'rb') as in_fh:
-      reader = PdfFileReader(in_fh)
-      out_file = PdfFileWriter()
-      for row in self.__pages_model:
-        page_info = row[1]
-        if not page_info.deleted:
-          page = reader.getPage(page_info.pagenum)
-          crop_setting = page_info.crop_setting
-          if not crop_setting.empty():
-            x, y, w, h = (crop_setting['x'],
-                          crop_setting['y'],
-                          crop_setting['w'],
-                          crop_setting['h'])
-            # scale it, convert to real poppler page coordinates
-            scale = self.__canvas.get_scale()
-            x1, y1, w1, h1 = (x / scale, y / scale, w / scale, h / scale)
-            # it's strange but cropBox.height != cropBox.upper_left_y -
-            # cropBox.upper_left_x.  we should use the latter.
-            h0 = float(page.cropBox.getUpperLeft_y() -
-                       page.cropBox.getLowerLeft_y())
-            w0 = float(page.cropBox.getUpperRight_x() -
-                       page.cropBox.getUpperLeft_x())
-
-            # convert poppler coordinates to pyPdf coordinates
-            rotateAngle = page.get("/Rotate", 0)
-            if rotateAngle < 0:
-              rotateAngle = 360 + currentAngle
-            if rotateAngle == 0:
-              x1, y1 = x1, h0 - y1 - h1
-            elif rotateAngle == 90:
-              x1, y1, w1, h1 = y1, x1, h1, w1
-            elif rotateAngle == 180:
-              pass
-            elif rotateAngle == 270:
-              x1, y1 = h0 - y1 - h1, w0 - x1 - w1
-            else:
-              raise Exception('Invalid rotate angle: ' + rotateAngle)
-
-            # poppler API provides only width and height while pyPdf
-            # provides far more size information.  poppler width and height
-            # doesn't always match pyPdf mediaBox.  Instead, we need to use
-            # pyPdf cropBox size to rectify the calculated cropping box.
-            x1, y1 = (x1 + float(page.cropBox.getLowerLeft_x()),
-                      y1 + float(page.cropBox.getLowerLeft_y()))
-
-            # now let's crop it.
-            page.cropBox.lowerLeft = (x1, y1)
-            page.cropBox.upperRight = (x1+w1, y1+h1)
-            page.mediaBox.lowerLeft = page.cropBox.lowerLeft
-            page.mediaBox.upperRight = page.cropBox.upperRight
-          out_file.addPage(page)
-      out_file.write(open(new_pdf_file_name, 'wb'))
+    pages = []
+    for pagenum in range(len(self.__pages_model)):
+      page_info = self.__pages_model.page_info(pagenum)
+      if not page_info.deleted:
+        pages.append((page_info.pagenum, page_info.crop))
+
+    self.__task_progress.set_fraction(0.0)
+    self.__task_progress.set_text('Exporting %s' %
+                                    os.path.basename(new_pdf_file_name))
+    self.__task_progress.show()
+    self.__task_cancel.show()
+    # The warm reader goes to this export, the next one gets a new reader.
+    reader, self.__warm_reader = self.__warm_reader, None
+    self.__exporter = Exporter(self.__mapped_file or self.__pdf_filename,
+                               reader, pages, new_pdf_file_name,
+                               self.__on_task_progress,
+                               self.__on_export_done)
 
     return True
 
 
+  def __on_task_cancel_clicked(self, button):
+    for task in (self.__exporter, self.__page_task):
+      if task:
+        task.cancelled = True
+
+
+  def __on_task_progress(self, text, fraction):
+    if self.__exporter or self.__page_task:
+      self.__task_progress.set_text(text)
+      if fraction is None:
+        self.__task_progress.pulse()
+      else:
+        self.__task_progress.set_fraction(fraction)
+      if self.__ghost_images and self.__page_task:
+        self.__show_ghost()
+
+
+  def __on_export_done(self, error):
+    self.__exporter = None
+    if self.__quit_after_export:
+      Gtk.main_quit()
+      return
+    self.__task_progress.hide()
+    self.__task_cancel.hide()
+    if (self.__pdf_document and not self.__warm_reader and
+        not self.__reader_warmup):
+      self.__reader_warmup = ReaderWarmup(
+          self.__mapped_file or self.__pdf_filename, self.__n_pages,
+          self.__on_reader_ready)
+    if error and not isinstance(error, ExportCancelled):
+      msg_dialog = Gtk.MessageDialog(self,0,Gtk.MessageType.ERROR,Gtk.ButtonsType.CANCEL)
+      msg_dialog.set_markup('Export failed: %s' %
+                            GLib.markup_escape_text(str(error)))
+      msg_dialog.run()
+      msg_dialog.destroy()
+
+
+  def __on_reader_ready(self, reader):
+    self.__reader_warmup = None
+    if self.__warm_reader:
+      self.__warm_reader.close()
+    self.__warm_reader = reader
+
+
+  def __drop_warm_reader(self):
+    if self.__reader_warmup:
+      self.__reader_warmup.cancelled = True
+      self.__reader_warmup = None
+    if self.__warm_reader:
+      self.__warm_reader.close()
+      self.__warm_reader = None
+
+
   def external_load_pdf_file(self, filename):
     self.__load_pdf_file(filename)
-    self.__pages_view.get_selection().select_iter(self.__pages_model.get_iter_first())
 
 
   def __load_pdf_file(self, filename):
@@ -982,69 +2755,536 @@ class MainWindow(Gtk.Window):
     LAST_OPEN_FOLDER = os.path.dirname(filename)
 
     filename = os.path.abspath(filename)
-    self.__pdf_document = Poppler.Document.new_from_file(
-      'file://%s' % filename, None)
-    self.__n_pages = self.__pdf_document.get_n_pages()
-
-    self.__pages_model.clear()
-
-    # 1-st page share its cropping settings with all pages until 2-nd page
-    # cropping is configured. Then, 1-st and 2-nd pages do share its cropping
-    # settings with odd and even pages respectively. Cropping for other pages
-    # is configured independently.
-    if self.__n_pages > 0:
-      size = self.__pdf_document.get_page(0).get_size()
-      self.__pages_model.append(
-          ["1", PageInfo(0, self.__odd_crop, size)])
-    if self.__n_pages > 1:
-      self.__pages_model.append(
-          ["2", PageInfo(1, self.__even_crop, size)])
-
-    for i in range(2, self.__n_pages):
-      if i % 2 == 0:
-        self.__pages_model.append(
-            [str(i+1),
-             PageInfo(i, CropSetting(self.__odd_crop), size)])
-      else:
-        self.__pages_model.append(
-            [str(i+1), PageInfo(i, CropSetting(self.__even_crop), size)])
+    self.__render_worker.cancel()
+    self.__render_cache.clear()
+    self.__thumbnails.clear()
+    self.__pending_thumbnails.clear()
+    if self.__loader:
+      self.__loader.cancelled = True
+    if self.__geometry_scan:
+      self.__geometry_scan.cancelled = True
+      self.__geometry_scan = None
+    self.__drop_warm_reader()
+    if self.__page_task:
+      self.__page_task.cancelled = True
+    self.__ghost_images = None
+    self.__ghost_button.set_active(False)
+
+    # The previous document is dropped right away, and the new one is opened
+    # in the background while the window keeps repainting.
+    self.__pdf_document = None
+    self.__n_pages = None
+    self.__current_page = None
+    self.__mapped_file = None
+    if not self.__page_slot:
+      self.__page_slot = PageSlot(self.__canvas.get_root_item(),
+                                  on_auto_crop=self.__auto_crop)
+      self.__page_slot.show(not self.__continuous)
+      self.__pdf_view = self.__page_slot.view
+    self.__release_slots()
+    self.__page_tops = array('d')
+    self.__pages_model = PagesModel()
+    self.__pages_view.set_model(self.__pages_model)
+    self.__pdf_view.redraw()
+
+    self.__progress.set_text('Opening %s' % os.path.basename(filename))
+    self.__progress.show()
+    if self.__load_pulse_id is None:
+      self.__load_pulse_id = GLib.timeout_add(LOAD_PULSE_MS,
+                                              self.__on_load_pulse)
+    self.__loader = DocumentLoader(
+        filename,
+        lambda *args: self.__on_document_loaded(filename, *args),
+        self.__on_document_failed)
+
+
+  def __on_load_pulse(self):
+    self.__progress.pulse()
+    return True
+
+
+  def __stop_load_pulse(self):
+    if self.__load_pulse_id is not None:
+      GLib.source_remove(self.__load_pulse_id)
+      self.__load_pulse_id = None
+
+
+  def __on_document_loaded(self, filename, document, n_pages, first_size,
+                          mapped):
+    self.__loader = None
+    self.__stop_load_pulse()
+    self.__pdf_document = document
+    self.__mapped_file = mapped
+    self.__n_pages = n_pages
+    self.__file_identity = file_identity(filename)
+    self.__gray_chosen = False
+    self.__set_gray(False)
+
+    # Until the scan gets to them, pages take the size of the 1-st page.
+    if first_size:
+      geometry = PageGeometry(n_pages, first_size)
+    else:
+      geometry = PageGeometry(n_pages)
+    self.__geometry = geometry
+
+    crop_table = CropTable(n_pages, self.__crop_table)
+    self.__crop_table = crop_table
 
-    if not self.__pdf_view:
-      self.__pdf_view = PdfView()
-      self.__canvas.get_root_item().add_child(self.__pdf_view, next_index())
+    def make_page_info(i):
+      return PageInfo(i, crop_table, geometry)
+
+    self.__pages_model = PagesModel(n_pages, make_page_info)
+    self.__pages_view.set_model(self.__pages_model)
+
+    # Selecting the 1-st page puts its render at the head of the queue, ahead
+    # of the thumbnails, the gray detection and the geometry scan.
+    if n_pages > 0:
+      self.__pages_view.get_selection().select_iter(
+          self.__pages_model.get_iter_first())
+    self.__on_geometry_scanned(0, [])
+    if self.__continuous:
+      self.__layout_pages()
+      self.__update_slots()
+    # Page sizes come from Poppler alone; the reader for the 1-st export is
+    # warmed up alongside, without holding them back.
+    self.__geometry_scan = GeometryScan(document, n_pages,
+                                        self.__on_geometry_scanned)
+    self.__reader_warmup = ReaderWarmup(mapped or filename, n_pages,
+                                        self.__on_reader_ready)
+
+    if numpy is not None and n_pages > 0:
+      self.__detect_gray()
+
+
+  def __on_document_failed(self, error):
+    self.__loader = None
+    self.__stop_load_pulse()
+    self.__progress.hide()
+    self.__statusbar.pop(self.__cache_status_id)
+    self.__statusbar.push(self.__cache_status_id,
+                          'Cannot open %s: %s' % (self.__pdf_filename, error))
+
+
+  def __on_geometry_scanned(self, start, sizes):
+    self.__geometry.update(start, sizes)
+    page_info = self.__current_page
+    if self.__continuous:
+      if sizes:
+        self.__layout_pages(start)
+        self.__update_slots()
+    elif page_info and start <= page_info.pagenum < start + len(sizes):
+      # The page on screen was sized from its render, but keep the bounds in
+      # line with the scan in case the view was rescaled since.
+      scale = self.__canvas.get_scale()
+      w, h = page_info.size
+      self.__set_page_region(int(int(w) * scale), int(int(h) * scale))
+    scanned, n_pages = self.__geometry.scanned, len(self.__geometry)
+    if scanned < n_pages:
+      self.__progress.set_fraction(float(scanned) / n_pages)
+      self.__progress.set_text('Scanning pages: %d / %d' % (scanned, n_pages))
+      self.__progress.show()
+    else:
+      self.__progress.hide()
 
 
   def __on_page_selected(self, selection=None):
+    if self.__continuous:
+      # Only an actual selection scrolls, not a zoom or a gray switch.
+      if selection:
+        tree_store, tree_iter = selection.get_selected()
+        if tree_iter and self.__page_tops:
+          pagenum = tree_store[tree_iter][1].pagenum
+          self.__canvas.scroll_to(0, self.__page_tops[pagenum])
+      self.__refresh_slots()
+      return
+
     if not selection:
       selection = self.__pages_view.get_selection()
 
     tree_store, tree_iter = selection.get_selected()
+    self.__render_worker.cancel('page')
+    self.__render_worker.cancel('prefetch')
+    self.__render_worker.cancel('tile')
+    self.__pending_tiles.clear()
     if tree_iter:
       page_info = tree_store[tree_iter][1]
-      self.__current_page = self.__pdf_document.get_page(page_info.pagenum)
-      page_width, page_height = self.__current_page.get_size()
-      w, h = int(page_width), int(page_height)
       scale = self.__canvas.get_scale()
-      w, h = int(w * scale), int(h * scale)
-      self.__canvas.set_bounds(0, 0, w, h)
+      result = self.__render_cache.get(
+          self.__page_key(page_info.pagenum, scale))
+      if result:
+        self.__on_page_rendered(page_info, result)
+        return
+
+      # The page currently shown stays on screen until a quick low resolution
+      # preview, then the page itself, have been rendered in the background.
+      if scale > PREVIEW_SCALE:
+        self.__render_worker.submit(RenderJob(
+            'page',
+            self.__preview_renderer(page_info.pagenum, scale),
+            lambda result: self.__on_preview_rendered(page_info, result),
+            PRIORITY_PAGE))
+      self.__render_worker.submit(RenderJob(
+          'page',
+          self.__renderer(page_info.pagenum, scale),
+          lambda result: self.__on_page_rendered(page_info, result),
+          PRIORITY_PAGE))
+    else:
+      self.__current_page = None
+      self.__pdf_view.redraw()
 
-      self.__canvas.page_region = Gdk.Rectangle()
-      self.__canvas.page_region.width, self.__canvas.page_region.height = w, h
-      pw, ph = page_width, page_height
-      page = self.__current_page
-      # Render to a pixmap
-      scale = min(w/pw, h/ph)
-      surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
-      context = cairo.Context(surface)
-      context.scale(scale, scale)
-      context.save()
-      page.render(context)
-      context.restore()
-      # Convert pixmap to pixbuf
-      pixbuf  = Gdk.pixbuf_get_from_surface (surface, 0, 0, w, h)
-      self.__pdf_view.redraw(page_info, pixbuf)
+
+  # Render cache key of a page. The file identity keeps a job still running
+  # for the previous document from filling the cache under the same key.
+  def __page_key(self, pagenum, scale):
+    return self.__file_identity, pagenum, scale, self.__gray
+
+
+  def __renderer(self, pagenum, scale):
+    document = self.__pdf_document
+    cache = self.__render_cache
+    disk_cache = self.__disk_cache
+    store = self.__store_on_disk
+    gray = self.__gray
+    key = self.__page_key(pagenum, scale)
+    disk_key = (self.__file_identity, 'page', pagenum, scale, gray)
+
+    def render():
+      result = cache.peek(key)
+      if not result:
+        surface = disk_cache.get(disk_key)
+        if surface is not None:
+          w, h = surface.get_width(), surface.get_height()
+        else:
+          surface, w, h = render_page(document, pagenum, scale,
+                                      TILED_RENDER_BYTES, gray)
+          if surface is not None:
+            store(disk_key, surface)
+        if surface is None:
+          return None, w, h
+        result = (surface, w, h)
+        cache.put(key, result, surface_nbytes(surface))
+      return result
+
+    return render
+
+
+  # Compressing a bitmap into the disk cache is left to a job of its own, run
+  # once the render result is delivered rather than delaying it.
+  def __store_on_disk(self, key, surface):
+    disk_cache = self.__disk_cache
+    self.__render_worker.submit(RenderJob(
+        'store', lambda: disk_cache.put(key, surface), priority=PRIORITY_STORE))
+
+
+  def __preview_renderer(self, pagenum, scale):
+    document = self.__pdf_document
+    render = self.__renderer(pagenum, PREVIEW_SCALE)
+
+    def render_preview():
+      surface = render()[0]
+      with POPPLER_LOCK:
+        w, h, _ = page_pixel_size(document.get_page(pagenum), scale)
+      return surface, w, h
+
+    return render_preview
+
+
+  # Whether page_info is still the page selected in the page list.
+  def __is_selected(self, page_info):
+    tree_store, tree_iter = self.__pages_view.get_selection().get_selected()
+    return tree_iter is not None and tree_store[tree_iter][1] is page_info
+
+
+  def __on_preview_rendered(self, page_info, result):
+    if not self.__is_selected(page_info):
+      return
+    surface, w, h = result
+    if surface:
+      # Same bounds as the final page, so the cropping box does not move
+      # when the page replaces its preview.
+      self.__set_page_region(w, h)
+      self.__pdf_view.redraw(page_info, surface, w, h)
+
+
+  def __set_page_region(self, w, h):
+    if not self.__continuous:
+      self.__canvas.set_bounds(0, 0, w, h)
+    self.__page_slot.place(0, 0, w, h)
+
+
+  def __on_page_rendered(self, page_info, result):
+    if not self.__is_selected(page_info):
+      return
+    surface, w, h = result
+    self.__current_page = page_info
+    self.__set_page_region(w, h)
+    if surface:
+      self.__tiled = False
+      self.__pdf_view.redraw(page_info, surface)
     else:
+      self.__tiled = True
+      self.__pdf_view.redraw_tiled(page_info, w, h)
+      self.__request_tiles()
+    self.__update_cache_status()
+    self.__prefetch_around(page_info.pagenum, self.__canvas.get_scale())
+
+
+  def __on_viewport_changed(self, *args):
+    if self.__continuous:
+      self.__update_slots()
+    elif self.__tiled and self.__current_page:
+      self.__request_tiles()
+
+
+  def __request_tiles(self):
+    page_info = self.__current_page
+    region = self.__page_slot.region
+    scale = self.__canvas.get_scale()
+    hadj = self.__canvas_window.get_hadjustment()
+    vadj = self.__canvas_window.get_vadjustment()
+    x0, y0 = self.__canvas.convert_from_pixels(hadj.get_value(),
+                                               vadj.get_value())
+    x1, y1 = self.__canvas.convert_from_pixels(
+        hadj.get_value() + hadj.get_page_size(),
+        vadj.get_value() + vadj.get_page_size())
+    x0, y0 = max(0, x0 - TILE_MARGIN), max(0, y0 - TILE_MARGIN)
+    x1 = min(region.width, x1 + TILE_MARGIN)
+    y1 = min(region.height, y1 + TILE_MARGIN)
+    self.__pdf_view.prune_tiles(x0, y0, x1, y1)
+
+    wanted = set()
+    for ty in range(int(y0) // TILE_SIZE * TILE_SIZE, int(y1), TILE_SIZE):
+      for tx in range(int(x0) // TILE_SIZE * TILE_SIZE, int(x1), TILE_SIZE):
+        key = (self.__file_identity, page_info.pagenum, scale, self.__gray,
+               tx, ty)
+        wanted.add(key)
+        if self.__pdf_view.has_tile(key) or key in self.__pending_tiles:
+          continue
+        surface = self.__render_cache.get(key)
+        if surface:
+          self.__pdf_view.add_tile(key, tx, ty, surface)
+          continue
+        tw = min(TILE_SIZE, region.width - tx)
+        th = min(TILE_SIZE, region.height - ty)
+        self.__pending_tiles[key] = self.__render_worker.submit(RenderJob(
+            'tile',
+            self.__tile_renderer(key, tw, th),
+            lambda surface, key=key: self.__on_tile_rendered(key, surface),
+            PRIORITY_PAGE))
+
+    # Tiles scrolled out of view before being rendered are not needed anymore.
+    for key in list(self.__pending_tiles):
+      if key not in wanted:
+        self.__pending_tiles.pop(key).cancelled = True
+
+
+  def __tile_renderer(self, key, w, h):
+    document = self.__pdf_document
+    cache = self.__render_cache
+    _, pagenum, scale, gray, x, y = key
+
+    def render():
+      surface = cache.peek(key)
+      if not surface:
+        surface = render_tile(document, pagenum, scale, x, y, w, h, gray)
+        cache.put(key, surface, surface_nbytes(surface))
+      return surface
+
+    return render
+
+
+  def __on_tile_rendered(self, key, surface):
+    self.__pending_tiles.pop(key, None)
+    self.__pdf_view.add_tile(key, key[4], key[5], surface)
+    self.__update_cache_status()
+
+
+  def __prefetch_around(self, pagenum, scale):
+    # Queue the neighbouring pages, nearest first, behind any page request.
+    # They are dropped as soon as the user selects another page or zooms.
+    for distance in range(1, PREFETCH_PAGES + 1):
+      for neighbour in (pagenum + distance, pagenum - distance):
+        if (0 <= neighbour < self.__n_pages and
+            self.__page_key(neighbour, scale) not in self.__render_cache):
+          self.__render_worker.submit(RenderJob(
+              'prefetch',
+              self.__renderer(neighbour, scale),
+              priority=PRIORITY_PREFETCH))
+
+
+  def __on_continuous_toggled(self, button):
+    self.__continuous = button.get_active()
+    self.__render_worker.cancel('page')
+    self.__render_worker.cancel('prefetch')
+    self.__render_worker.cancel('tile')
+    self.__pending_tiles.clear()
+    if self.__page_slot:
+      self.__page_slot.show(not self.__continuous)
+    if not self.__pdf_document:
+      return
+    if self.__continuous:
       self.__pdf_view.redraw()
+      self.__layout_pages()
+      self.__on_page_selected(self.__pages_view.get_selection())
+    else:
+      self.__release_slots()
+      self.__on_page_selected()
+
+
+  def __layout_pages(self, start=0):
+    # Pages are stacked at the canvas scale, with the page bounds rounded
+    # the way the single page view rounds them. Only the pages from start on
+    # moved when their sizes were just scanned.
+    scale = self.__canvas.get_scale()
+    geometry = self.__geometry
+    n_pages = len(geometry)
+    tops = self.__page_tops
+    if not start or len(tops) != n_pages + 1:
+      start = 0
+      tops = array('d', [0.0]) * (n_pages + 1)
+    if numpy is not None:
+      heights = numpy.frombuffer(geometry.heights)[start:]
+      steps = (heights.astype(numpy.int64) * scale).astype(numpy.int64)
+      numpy.frombuffer(tops)[start + 1:] = (
+          tops[start] + numpy.cumsum(steps + CONTINUOUS_GAP))
+    else:
+      top = tops[start]
+      for pagenum in range(start, n_pages):
+        top += int(int(geometry.heights[pagenum]) * scale) + CONTINUOUS_GAP
+        tops[pagenum + 1] = top
+    self.__page_tops = tops
+    width = int(int(geometry.max_size()[0]) * scale)
+    top = tops[n_pages]
+    self.__canvas.set_bounds(0, 0, width, max(top - CONTINUOUS_GAP, 0))
+    for pagenum, slot in self.__slots.items():
+      self.__place_slot(pagenum, slot)
+      slot.view.rescale(slot.region.width, slot.region.height)
+
+
+  def __place_slot(self, pagenum, slot):
+    scale = self.__canvas.get_scale()
+    w, h = self.__geometry.size(pagenum)
+    slot.place(0, self.__page_tops[pagenum],
+               int(int(w) * scale), int(int(h) * scale))
+
+
+  def __update_slots(self):
+    # Only the pages within CONTINUOUS_MARGIN of the viewport have canvas
+    # items; the slots of the others are recycled.
+    tops = self.__page_tops
+    if not self.__continuous or len(tops) < 2:
+      return
+    hadj = self.__canvas_window.get_hadjustment()
+    vadj = self.__canvas_window.get_vadjustment()
+    _, y0 = self.__canvas.convert_from_pixels(hadj.get_value(),
+                                              vadj.get_value())
+    _, y1 = self.__canvas.convert_from_pixels(
+        hadj.get_value(), vadj.get_value() + vadj.get_page_size())
+    n_pages = len(tops) - 1
+    first = max(bisect.bisect_right(tops, y0 - CONTINUOUS_MARGIN) - 1, 0)
+    end = min(bisect.bisect_left(tops, y1 + CONTINUOUS_MARGIN), n_pages)
+
+    for pagenum in list(self.__slots):
+      if not first <= pagenum < end:
+        self.__release_slot(pagenum)
+    for pagenum in range(first, end):
+      if pagenum not in self.__slots:
+        if self.__free_slots:
+          slot = self.__free_slots.pop()
+        else:
+          slot = PageSlot(self.__canvas.get_root_item(),
+                          self.__on_crop_changed, self.__auto_crop)
+        slot.ghosts = self.__ghosts
+        self.__slots[pagenum] = slot
+        self.__place_slot(pagenum, slot)
+        slot.show(True)
+        self.__show_slot(pagenum, slot)
+
+
+  def __show_slot(self, pagenum, slot):
+    page_info = self.__pages_model.page_info(pagenum)
+    w, h = slot.region.width, slot.region.height
+    scale = self.__canvas.get_scale()
+    result = self.__render_cache.get(self.__page_key(pagenum, scale))
+    if result and result[0]:
+      slot.view.redraw(page_info, result[0], w, h)
+      return
+
+    # Until the page is rendered it is shown blank, or from its preview.
+    preview = self.__render_cache.peek(self.__page_key(pagenum, PREVIEW_SCALE))
+    if preview and preview[0]:
+      slot.view.redraw(page_info, preview[0], w, h)
+    else:
+      slot.view.redraw_tiled(page_info, w, h)
+    self.__render_slot(pagenum, scale)
+
+
+  def __render_slot(self, pagenum, scale):
+    job = self.__slot_jobs.pop(pagenum, None)
+    if job:
+      job.cancelled = True
+    self.__slot_jobs[pagenum] = self.__render_worker.submit(RenderJob(
+        'slot',
+        self.__renderer(pagenum, scale),
+        lambda result: self.__on_slot_rendered(pagenum, scale, result),
+        PRIORITY_PAGE))
+
+
+  def __on_slot_rendered(self, pagenum, scale, result):
+    self.__slot_jobs.pop(pagenum, None)
+    slot = self.__slots.get(pagenum)
+    if slot is None:
+      return
+    if result[0]:
+      slot.view.redraw(slot.page_info, result[0],
+                       slot.region.width, slot.region.height)
+      self.__update_cache_status()
+    elif scale != PREVIEW_SCALE:
+      # Pages too large to render whole at this scale are only previewed
+      # here, the single page view renders them in tiles.
+      self.__render_slot(pagenum, PREVIEW_SCALE)
+
+
+  def __refresh_slots(self):
+    self.__render_worker.cancel('slot')
+    self.__slot_jobs.clear()
+    for pagenum, slot in self.__slots.items():
+      self.__show_slot(pagenum, slot)
+    self.__update_slots()
+
+
+  def __release_slot(self, pagenum):
+    slot = self.__slots.pop(pagenum)
+    job = self.__slot_jobs.pop(pagenum, None)
+    if job:
+      job.cancelled = True
+    slot.view.redraw()
+    slot.show(False)
+    self.__free_slots.append(slot)
+
+
+  def __release_slots(self):
+    for pagenum in list(self.__slots):
+      self.__release_slot(pagenum)
+
+
+  def __on_crop_changed(self):
+    # Pages inherit the crop of their odd or even group, so an edit may move
+    # the box of any page on screen.
+    if self.__pdf_view:
+      self.__pdf_view.update_cropping_box()
+    for slot in self.__slots.values():
+      slot.view.update_cropping_box()
+
+
+  def __update_cache_status(self):
+    cache = self.__render_cache
+    self.__statusbar.pop(self.__cache_status_id)
+    self.__statusbar.push(
+        self.__cache_status_id,
+        'Render cache: %d bitmaps, %.1f / %.0f MB, %d hits, %d misses' % (
+            len(cache), cache.nbytes / 1048576.0, cache.max_bytes / 1048576.0,
+            cache.hits, cache.misses))
 
 
 if __name__ == '__main__':
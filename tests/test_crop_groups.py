@@ -0,0 +1,124 @@
+import os
+import sys
+import unittest
+
+try:
+  import gi
+  import numpy
+except ImportError:
+  gi = numpy = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'debian', 'usr', 'share', 'pdf-quench'))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+
+@unittest.skipIf(gi is None or numpy is None, 'needs gi and numpy')
+class CropGroupsTest(unittest.TestCase):
+  def setUp(self):
+    import pdf_quench
+    self.crop_groups = pdf_quench.crop_groups
+    self.CropTable = pdf_quench.CropTable
+
+
+  def test_outliers_are_set_apart(self):
+    boxes = [(50, 60, 400, 600)] * 8
+    boxes[4] = (10, 60, 440, 600)
+    odd, even, overrides = self.crop_groups(boxes)
+    self.assertEqual(odd, (50, 60, 400, 600))
+    self.assertEqual(even, (50, 60, 400, 600))
+    self.assertEqual(overrides, {4: (10, 60, 440, 600)})
+
+
+  def test_group_without_inliers(self):
+    # A blank 2-nd page, the 4-th and 6-th reaching out on opposite sides.
+    boxes = [(50, 60, 400, 600), None, (50, 60, 400, 600),
+             (0, 60, 300, 600), (50, 60, 400, 600), (200, 60, 300, 600)]
+    odd, even, overrides = self.crop_groups(boxes)
+    self.assertEqual(odd, (50, 60, 400, 600))
+    self.assertEqual(even, (0, 60, 300, 600))
+    self.assertEqual(overrides, {5: (200, 60, 300, 600)})
+
+
+  def test_cover_page_is_set_apart(self):
+    cover, text = (0, 0, 612, 792), (60, 70, 480, 640)
+    odd, even, overrides = self.crop_groups([cover] + [text] * 19)
+    self.assertEqual(odd, text)
+    self.assertEqual(even, text)
+    self.assertEqual(overrides, {0: cover})
+
+
+  def test_set_groups_detaches_cover_page(self):
+    cover, text = (0, 0, 612, 792), (60, 70, 480, 640)
+    table = self.CropTable(20)
+    table.set_groups(*self.crop_groups([cover] + [text] * 19))
+    self.assertEqual(table.get(0), cover)
+    self.assertEqual(table.get(2), text)
+    self.assertEqual(table.row(0), 0)
+    table.set(2, 50, 60, 500, 660)
+    self.assertEqual(table.get(0), cover)
+    self.assertEqual(table.get(4), (50, 60, 500, 660))
+
+
+@unittest.skipIf(gi is None or numpy is None, 'needs gi and numpy')
+class ClusterPagesTest(unittest.TestCase):
+  TEXT = (60, 70, 480, 640)
+  PLATE = (20, 20, 572, 752)
+  SIZE = (612, 792)
+
+  def setUp(self):
+    import pdf_quench
+    self.cluster_pages = pdf_quench.cluster_pages
+    self.CropTable = pdf_quench.CropTable
+
+
+  def clustered_table(self, boxes):
+    table = self.CropTable(len(boxes))
+    table.set_groups((50, 50, 500, 700), (40, 40, 520, 720), {})
+    table.set_clusters(self.cluster_pages(boxes, [self.SIZE] * len(boxes)))
+    return table
+
+
+  def test_distinct_layouts_are_grouped_apart(self):
+    boxes = [self.TEXT] * 10
+    boxes[3] = boxes[7] = self.PLATE
+    clusters = sorted(self.cluster_pages(boxes, [self.SIZE] * 10),
+                      key=lambda cluster: len(cluster[1]))
+    self.assertEqual(clusters, [(self.PLATE, [3, 7]),
+                                (self.TEXT, [0, 1, 2, 4, 5, 6, 8, 9])])
+
+
+  def test_blank_pages_follow_odd_and_even_settings(self):
+    boxes = [self.TEXT] * 10
+    boxes[4] = boxes[5] = None
+    table = self.clustered_table(boxes)
+    self.assertEqual(table.groups(), 1)
+    self.assertEqual(table.get(3), self.TEXT)
+    self.assertEqual(table.get(4), (50, 50, 500, 700))
+    self.assertEqual(table.get(5), (40, 40, 520, 720))
+
+
+  def test_editing_a_page_edits_its_group(self):
+    boxes = [self.TEXT] * 10
+    boxes[3] = boxes[7] = self.PLATE
+    table = self.clustered_table(boxes)
+    table.set(3, 10, 10, 590, 770)
+    self.assertEqual(table.get(7), (10, 10, 590, 770))
+    self.assertEqual(table.get(2), self.TEXT)
+
+
+  def test_set_groups_removes_the_groups(self):
+    boxes = [self.TEXT] * 10
+    boxes[3] = boxes[7] = self.PLATE
+    table = self.clustered_table(boxes)
+    self.assertEqual(table.groups(), 2)
+    table.set_groups(self.TEXT, self.TEXT, {3: self.PLATE})
+    self.assertEqual(table.groups(), 0)
+    self.assertEqual(table.get(3), self.PLATE)
+    self.assertEqual(table.get(7), self.TEXT)
+    table.set(3, 10, 10, 590, 770)
+    self.assertEqual(table.get(7), self.TEXT)
+
+
+if __name__ == '__main__':
+  unittest.main()